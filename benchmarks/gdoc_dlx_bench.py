@@ -0,0 +1,119 @@
+"""
+Offline benchmark for gdoc-dlx. Generates a synthetic gDoc payload, serves it
+from a local stand-in for the gDoc API and runs gdoc_dlx.run end to end against
+moto S3 and a mongomock DLX database. Prints a JSON report with throughput,
+peak RSS and the time spent in each stage, so that changes can be compared
+across releases.
+
+Requires moto and mongomock in addition to the package requirements.
+
+Usage:
+    python benchmarks/gdoc_dlx_bench.py --documents 2000 --languages 6 --workers 4
+"""
+
+import os, json, time, resource
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from gdoc_api.tests.gdoc_server import LANGUAGES, GdocServer, make_metadata
+
+def run(*, documents: int = 1000, languages: int = 6, naming: str = 'jobId', pdf_size: int = 100_000, **kwargs) -> dict:
+    """Runs gdoc_dlx.run against the local stand-ins and returns the report.
+    `kwargs` are passed to gdoc_dlx.run"""
+
+    import boto3
+    from moto import mock_aws
+
+    os.environ.update(
+        {
+            'DLX_ENV': 'testing',
+            'GDOC_ENV': 'testing',
+            'AWS_ACCESS_KEY_ID': 'testing',
+            'AWS_SECRET_ACCESS_KEY': 'testing',
+            'AWS_DEFAULT_REGION': 'us-east-1',
+            'OAUTHLIB_INSECURE_TRANSPORT': '1' # the local token endpoint is http
+        }
+    )
+    os.environ.pop('GDOC_API_TESTING', None)
+
+    from gdoc_api.scripts import gdoc_dlx
+
+    records = make_metadata(documents, languages, naming=naming)
+
+    with mock_aws(), GdocServer(records, pdf_size=pdf_size) as server:
+        ssm = boto3.client('ssm')
+        ssm.put_parameter(
+            Name='gdoc-testing-api-secrets',
+            Type='String',
+            Value=json.dumps(
+                {
+                    'token_url': server.token_url,
+                    'api_url': server.api_url,
+                    'ocp_apim_subscription_key': 'benchmark',
+                    'client_id': 'benchmark',
+                    'client_secret': 'benchmark',
+                    'scope': ['benchmark']
+                }
+            )
+        )
+        boto3.client('s3').create_bucket(Bucket='benchmark')
+
+        # build the payloads before timing
+        for symbol in dict.fromkeys(x['symbol1'] for x in records):
+            server.payload(symbol, True)
+
+        start = time.perf_counter()
+
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            summary = gdoc_dlx.run(
+                station='NY',
+                date='1970-01-01',
+                connection_string='mongomock://localhost',
+                database='benchmark',
+                s3_bucket='benchmark',
+                **kwargs
+            )
+
+        seconds = time.perf_counter() - start
+        size = sum(len(server.payload(symbol, True)) for symbol in dict.fromkeys(x['symbol1'] for x in records))
+
+    return {
+        'parameters': {'documents': documents, 'languages': languages, 'naming': naming, 'pdf_size': pdf_size, **kwargs},
+        'seconds': round(seconds, 3),
+        'documents_per_second': round(documents / seconds, 1),
+        'mb_per_second': round(size / seconds / 1024 ** 2, 2),
+        'api_requests': len(server.requests),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'summary': summary
+    }
+
+def main():
+    parser = ArgumentParser(prog='gdoc-dlx-bench')
+    parser.add_argument('--documents', type=int, default=1000)
+    parser.add_argument('--languages', type=int, default=6, choices=range(1, len(LANGUAGES) + 1))
+    parser.add_argument('--naming', choices=['jobId', 'odsNo'], default='jobId', help='the metadata field that the PDFs are named by')
+    parser.add_argument('--pdf_size', type=int, default=100_000, help='bytes')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--recursive', action='store_true')
+    parser.add_argument('--create_bibs', action='store_true')
+    parser.add_argument('--output', help='also write the report to this file')
+    args = parser.parse_args()
+
+    report = run(
+        documents=args.documents,
+        languages=args.languages,
+        naming=args.naming,
+        pdf_size=args.pdf_size,
+        workers=args.workers,
+        recursive=args.recursive,
+        create_bibs=args.create_bibs
+    )
+    print(json.dumps(report, indent=4, default=str))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4, default=str)
+
+###
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,86 @@
-# AWS Lambda function that runs gdoc_dlx 
+# AWS Lambda function that runs gdoc_dlx
+#
+# Events:
+#   {"duty_station": "NY", "days_ago": 1}
+#       runs the whole station-day
+#   {"duty_station": "NY", "days_ago": 1, "mode": "plan", "queue_url": "https://sqs..."}
+#       splits the station-day into work items and sends them to the queue, or returns them if there is no queue_url
+#   {"work_item": {...}}, or an SQS event with work items as the message bodies
+#       imports the symbols in the work items
 
-from gdoc_api.scripts import gdoc_dlx
-import sys, datetime
+import time, datetime, json
+
+# gdoc_dlx and its dependencies are imported on the first invocation rather than at init.
+# SSM parameters, DLX and S3 connections, the HTTP session and the gDoc token are kept
+# by gdoc_dlx for the life of the container, so warm invocations reuse them
+gdoc_dlx = None
+gdoc_dlx_fanout = None
 
 def handler(event, context):
+    global gdoc_dlx, gdoc_dlx_fanout
     print(f"Processing {event}")
-    
-    for param in ['duty_station', 'days_ago']:    
+
+    cold = gdoc_dlx is None
+    start = time.perf_counter()
+
+    if cold:
+        from gdoc_api.scripts import gdoc_dlx, gdoc_dlx_fanout
+
+    import_seconds = time.perf_counter() - start
+
+    if 'work_item' in event or 'Records' in event:
+        items = [event['work_item']] if 'work_item' in event else [json.loads(x['body']) for x in event['Records']]
+        summaries = [gdoc_dlx_fanout.work(item) for item in items]
+
+        return {
+            'status_code': 200,
+            'cold_start': cold,
+            'init_seconds': init_seconds(import_seconds, summaries[0] if summaries else None),
+            'summary': [{k: v for k, v in x.items() if k != 'metrics'} for x in summaries]
+        }
+
+    for param in ['duty_station', 'days_ago']:
         if event.get(param) is None:
             raise Exception(f'Event parameter "{param}" is required')
-    
+
     today = datetime.date.today()
     date = today - datetime.timedelta(days=event['days_ago'])
-    gdoc_dlx.run(station=event['duty_station'], date=date, recursive=True)
+
+    if event.get('mode') == 'plan':
+        items = gdoc_dlx_fanout.plan(station=event['duty_station'], date=date, workers=event.get('workers', 1), batch_size=event.get('batch_size', gdoc_dlx_fanout.BATCH_SIZE))
+
+        if event.get('queue_url'):
+            import boto3
+            sqs = boto3.client('sqs')
+
+            for i in range(0, len(items), 10):
+                sqs.send_message_batch(
+                    QueueUrl=event['queue_url'],
+                    Entries=[{'Id': str(item['batch']), 'MessageBody': json.dumps(item)} for item in items[i:i + 10]]
+                )
+
+        return {
+            'status_code': 200,
+            'cold_start': cold,
+            'work_items': len(items) if event.get('queue_url') else items
+        }
+
+    summary = gdoc_dlx.run(station=event['duty_station'], date=date, recursive=True, workers=event.get('workers', 1))
+
+    return {
+        'status_code': 200,
+        'cold_start': cold,
+        'init_seconds': init_seconds(import_seconds, summary),
+        'summary': {k: v for k, v in summary.items() if k != 'metrics'}
+    }
+
+def init_seconds(import_seconds, summary):
+    # there is no summary if an SQS event has no records
+    timers = summary['metrics']['timers'] if summary else {}
 
     return {
-        'status_code': 200
-    }
\ No newline at end of file
+        'import': round(import_seconds, 3),
+        'args': timers.get('init_args', 0),
+        'connect': timers.get('init_connect', 0),
+        'gdoc': timers.get('init_gdoc', 0)
+    }
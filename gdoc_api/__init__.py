@@ -1,16 +1,86 @@
-import os, requests, urllib, json, re, shutil
+import os, sys, io, mmap, time, asyncio, requests, urllib, json, re, hashlib
 from typing import Optional, Callable, Iterator
+from collections.abc import Mapping, Sequence
+from threading import Lock
 from datetime import datetime, timezone
-from tempfile import TemporaryFile
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
 from zipfile import ZipFile, BadZipFile
-from requests_oauthlib import OAuth2Session
-from oauthlib.oauth2 import BackendApplicationClient
 from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from gdoc_api.cache import PayloadCache
+from gdoc_api.metrics import Metrics
 
 TODAY = datetime.now(timezone.utc).strftime('%Y-%m-%d')
-class Gdoc():
+CHUNK_SIZE = 1024 * 1024 # bytes read from the API response at a time
+SPOOL_SIZE = 32 * 1024 * 1024 # payloads up to this size are kept in memory
+POOL_SIZE = 10 # connections kept open per host
+RETRIES = 5 # retries for connection errors, 429 and 5xx responses, and interrupted downloads
+BACKOFF = 1 # seconds, doubled for each retry
+TIMEOUT = (10, 300) # connect and read timeouts in seconds
+
+class TokenCache():
+    """Process-wide cache of OAuth tokens keyed by (token_url, client_id, scope).
+    Tokens are refreshed `margin` seconds before they expire. If `path` is 
+    provided, the tokens are also saved to that file so that they can be reused
+    across CLI runs."""
+
+    def __init__(self, path: os.PathLike = None, margin: int = 60):
+        self.path = path
+        self.margin = margin
+        self.tokens = {}
+        self.lock = Lock()
+
+    def get(self, key: tuple, fetch: Callable, force: bool = False) -> dict:
+        """Returns the cached token for `key`, calling `fetch` to get a new one if
+        there is no cached token, it is about to expire, or `force` is True"""
+
+        with self.lock:
+            if not self.tokens and self.path:
+                self._load()
+
+            token = self.tokens.get(key)
+
+            if force or not token or token['expires_at'] - self.margin < time.time():
+                token = dict(fetch())
+                token.setdefault('expires_at', time.time() + float(token.get('expires_in', 0)))
+                self.tokens[key] = token
+
+                if self.path:
+                    self._save()
+
+            return token
+
+    def clear(self) -> None:
+        with self.lock:
+            self.tokens = {}
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                self.tokens = {tuple(json.loads(key)): token for key, token in json.load(f).items()}
+        except (OSError, ValueError):
+            self.tokens = {}
+
+    def _save(self):
+        # the file contains credentials, so it is only readable by the owner
+        with open(os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump({json.dumps(key): token for key, token in self.tokens.items()}, f)
+
+TOKEN_CACHE = TokenCache(path=os.getenv('GDOC_TOKEN_CACHE'))
+
+class GdocClient():
+    """Credentials, connection and API parameter handling shared by Gdoc and 
+    AsyncGdoc"""
+
     def __init__(self, *, client_id, client_secret, token_url,
-        api_url, ocp_apim_subscription_key, scope):
+        api_url, ocp_apim_subscription_key, scope,
+        chunk_size: int = CHUNK_SIZE, spool_size: int = SPOOL_SIZE, use_mmap: bool = True,
+        session: requests.Session = None, pool_size: int = POOL_SIZE, retries: int = RETRIES, 
+        backoff: float = BACKOFF, timeout: tuple = TIMEOUT, cache: PayloadCache = None,
+        metrics: Metrics = None):
 
         self.client_id = client_id
         self.client_secret = client_secret
@@ -18,6 +88,14 @@ class Gdoc():
         self.api_url = api_url
         self.ocp_apim_subscription_key = ocp_apim_subscription_key
         self.scope = scope
+        self.chunk_size = chunk_size
+        self.spool_size = spool_size
+        self.use_mmap = use_mmap # memory-map payloads that are on disk
+        self.retries = retries
+        self.timeout = timeout
+        self.cache = cache
+        self.metrics = metrics or Metrics()
+        self.session = session or self.new_session(pool_size=pool_size, retries=retries, backoff=backoff)
         self.parameters = {
             'dateFrom': '',
             'dateTo': '',
@@ -25,30 +103,155 @@ class Gdoc():
             'DownloadFiles': '',
             'symbol': ''
         }
-        self._data = {}
-        self._zipfile = None # ZipFile https://docs.python.org/3/library/zipfile.html#zipfile-objects
         
-        # authenticate
-        if 'GDOC_API_TESTING' not in os.environ:
-            scope = ["gDoc2DataAPIAccess", "gDocFilesAPIAccess"]
-            auth = HTTPBasicAuth(self.client_id, self.client_secret)
-            client = BackendApplicationClient(client_id=self.client_secret) 
-            oauth = OAuth2Session(client=client, scope=self.scope)
+        # authenticate. Gdocs without a token_url only read saved payloads
+        if 'GDOC_API_TESTING' not in os.environ and token_url:
+            self.token
+
+    @staticmethod
+    def new_session(*, pool_size: int = POOL_SIZE, retries: int = RETRIES, backoff: float = BACKOFF) -> requests.Session:
+        """Returns a requests Session with a connection pool of `pool_size` that 
+        retries connection errors and 429/5xx responses with exponential backoff,
+        honoring the Retry-After header"""
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        return session
+
+    @property
+    def token(self) -> dict:
+        """Returns the OAuth token, which is shared by all Gdoc instances using
+        the same credentials until it is about to expire"""
+
+        return TOKEN_CACHE.get(self._token_key, self._fetch_token)
+
+    def refresh_token(self) -> dict:
+        """Gets a new OAuth token, replacing the cached one"""
+
+        return TOKEN_CACHE.get(self._token_key, self._fetch_token, force=True)
+
+    @property
+    def _token_key(self) -> tuple:
+        scope = self.scope if isinstance(self.scope, str) else ' '.join(self.scope)
+
+        return (self.token_url, self.client_id, scope)
+
+    def _fetch_token(self) -> dict:
+        # imported here so that the OAuth libraries are only loaded when a token is needed
+        from requests_oauthlib import OAuth2Session
+        from oauthlib.oauth2 import BackendApplicationClient
+
+        auth = HTTPBasicAuth(self.client_id, self.client_secret)
+        client = BackendApplicationClient(client_id=self.client_secret) 
+        oauth = OAuth2Session(client=client, scope=self.scope)
+        self.metrics.incr('token_fetches')
         
-            self.token = oauth.fetch_token(
+        with self.metrics.timer('token'):
+            return oauth.fetch_token(
                 token_url=self.token_url, 
                 auth=auth, 
                 scope=self.scope
             )
         
     @property
-    def data(self) -> dict:
-        if self._data:
-            return self._data
+    def options(self) -> dict:
+        """Returns the arguments needed to create another client with the same
+        credentials, settings and session"""
 
-        self.download()
+        return {
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'token_url': self.token_url,
+            'api_url': self.api_url,
+            'ocp_apim_subscription_key': self.ocp_apim_subscription_key,
+            'scope': self.scope,
+            'chunk_size': self.chunk_size,
+            'spool_size': self.spool_size,
+            'use_mmap': self.use_mmap,
+            'session': self.session,
+            'retries': self.retries,
+            'timeout': self.timeout,
+            'cache': self.cache,
+            'metrics': self.metrics
+        }
+
+    def set_param(self, name: str, value: str) -> None:
+        """Sets a single param to be used in the gDoc API call"""
+
+        self.parameters[name] = value
+
+    @property
+    def url(self) -> str:
+        """Returns the API URL for the current parameters"""
+
+        return self.api_url + '?' + '&'.join(map(lambda x: '{}={}'.format(x[0], x[1]), self.parameters.items()))
+
+    def _headers(self) -> Optional[dict]:
+        if 'GDOC_API_TESTING' in os.environ:
+            return None
+
+        return {
+            "Authorization": f"Bearer {self.token['access_token']}",
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Ocp-Apim-Subscription-Key": self.ocp_apim_subscription_key
+        }
+
+class Gdoc(GdocClient):
+    def __init__(self, *, languages: list = None, **kwargs):
+        super().__init__(**kwargs)
+        self.languages = set(languages) if languages else None # languageIds of the files to open. None is all
+        self.request_stats = [] # bytes, retries and time for each API request
+        self._data = None # Records
+        self._zipfile = None # ZipFile https://docs.python.org/3/library/zipfile.html#zipfile-objects
+        self._records = None # jobId/odsNo -> metadata record
+        self._members = None # filename stem -> zip member name
+        self._report = None # reconciliation of the metadata and the zip members
+        self._totals = None # totals of the reconciliation
+        self.path = None # path of a saved payload to read instead of making API requests
+        self.tempfile = None
+        self._mapped = None
+
+    @classmethod
+    def from_zip(cls, path: os.PathLike, **kwargs) -> 'Gdoc':
+        """Returns a Gdoc for a payload saved on the local disk, for example by
+        `download(save_as=...)`. No API requests are made, so no credentials
+        are needed. `kwargs` are the other Gdoc options"""
+
+        params = dict.fromkeys(('client_id', 'client_secret', 'token_url', 'api_url', 'ocp_apim_subscription_key', 'scope'))
+        g = cls(**{**params, **kwargs})
+        g.path = path
+        g.set_param('DownloadFiles', 'Y')
+
+        return g.download()
+
+    @property
+    def data(self) -> 'Records':
+        """Returns the metadata records from export.txt. The records are parsed 
+        from the zip file as they are iterated over the first time, and kept
+        once export.txt has been read to the end"""
+
+        if self._data is None:
+            self.download()
         
         return self._data
+
+    def iter_records(self) -> Iterator['Record']:
+        """Parses the metadata records in export.txt one at a time, without
+        keeping them"""
+
+        with io.TextIOWrapper(self.zipfile.open('export.txt'), encoding='utf-8-sig') as datafile:
+            for record in _iter_json_array(datafile):
+                yield Record(record)
     
     @property
     def zipfile(self) -> ZipFile:
@@ -61,91 +264,672 @@ class Gdoc():
         
         return self._zipfile
         
-    def set_param(self, name: str, value: str) -> None:
-        """Sets a single param to be used in the gDoc API call"""
+    @staticmethod
+    def file_stem(name: str) -> Optional[str]:
+        """Returns the part of a PDF member name that can be matched to the
+        jobId or odsNo in the metadata, or None if the member is not a PDF"""
 
-        self.parameters[name] = value
+        # filenames contain a series of digits (and letters?) preceeding the file extension that can be matched to the metadata
+        if match := re.search(r'(\w+)\.pdf$', name):
+            return match.group(1)
+
+    @property
+    def records(self) -> dict:
+        """Returns an index of the metadata records by jobId and odsNo. The
+        index is built once per payload"""
+
+        if self._records is None:
+            data, by_job, by_ods = self.data, {}, {}
+
+            with self.metrics.timer('metadata_index'):
+                # index both jobId and odsNo, as the field used to name the file has varied in the past.
+                # the first record with an id is used, as when the records were searched in order
+                for doc in data:
+                    if file_id := doc.get('odsNo'):
+                        by_ods.setdefault(file_id, doc)
+
+                    if file_id := doc.get('jobId'):
+                        by_job.setdefault(file_id, doc)
+
+            # jobId takes precedence if the same value is used as both
+            self._records = {**by_ods, **by_job}
+
+        return self._records
+
+    @property
+    def members(self) -> dict:
+        """Returns an index of the PDF members of the zip file by filename stem.
+        The index is built once per payload"""
+
+        if self._members is None:
+            names, members = self.zipfile.namelist(), {}
+
+            with self.metrics.timer('metadata_index'):
+                for name in names:
+                    if stem := self.file_stem(name):
+                        members[stem] = name
+
+            self._members = members
+
+        return self._members
+
+    def record_for(self, name: str) -> Optional[dict]:
+        """Returns the metadata record for the zip member `name`, or None if
+        there is no matching record"""
+
+        if stem := self.file_stem(name):
+            return self.records.get(stem)
+
+    def member_for(self, doc: dict) -> Optional[str]:
+        """Returns the name of the zip member containing the file for the
+        metadata record `doc`, or None if the file is not in the zip file"""
+
+        # check both jobId and odsNo as the name of the file, as it has varied in the past
+        for field in ('jobId', 'odsNo'):
+            if (file_id := doc.get(field)) and (name := self.members.get(file_id)):
+                return name
+
+    def reconcile(self) -> dict:
+        """Returns a report joining the metadata records and the PDF members of
+        the current payload: the matched files with their sizes, the files
+        without a record, the records without a file, and the ids used by more
+        than one record. The report is built once per payload"""
+
+        if self._report is None:
+            self._report = self._reconcile(details=True)
+
+        return self._report
+
+    def reconcile_totals(self) -> dict:
+        """Returns the totals of the `reconcile` report, without keeping the
+        matched files and the records without a file"""
+
+        if self._report is not None:
+            return self._report['totals']
+
+        if self._totals is None:
+            self._totals = self._reconcile(details=False)['totals']
+
+        return self._totals
+
+    def _reconcile(self, details: bool) -> dict:
+        with self.metrics.timer('reconcile'):
+            infos = {stem: info for info in self.zipfile.infolist() if (stem := self.file_stem(info.filename))}
+            ids, matched, missing = Counter(), [], []
+            totals = Counter(records=0, matched=0, missing_files=0, matched_bytes=0)
+
+            for doc in self.data:
+                ids.update({doc.get('jobId'), doc.get('odsNo')} - {None, ''})
+                totals['records'] += 1
+                # jobId takes precedence over odsNo, as in `member_for`
+                stem = next((x for x in (doc.get('jobId'), doc.get('odsNo')) if x and x in infos), None)
+
+                if stem:
+                    totals['matched'] += 1
+                    totals['matched_bytes'] += infos[stem].file_size
+                else:
+                    totals['missing_files'] += 1
+
+                if details:
+                    entry = {field: doc.get(field) for field in ('jobId', 'odsNo', 'symbol1', 'languageId', 'distributionType')}
+
+                    if stem:
+                        matched.append({**entry, 'member': infos[stem].filename, 'size': infos[stem].file_size, 'compressed_size': infos[stem].compress_size})
+                    else:
+                        missing.append(entry)
+
+            orphans = [{'member': infos[stem].filename, 'size': infos[stem].file_size} for stem in infos.keys() - ids.keys()]
+            duplicates = [{'id': x, 'records': n} for x, n in ids.items() if n > 1]
+
+        return {
+            'matched': matched,
+            'orphan_files': orphans,
+            'missing_files': missing,
+            'duplicate_ids': duplicates,
+            'totals': {
+                'records': totals['records'],
+                'members': len(infos),
+                'matched': totals['matched'],
+                'orphan_files': len(orphans),
+                'missing_files': totals['missing_files'],
+                'duplicate_ids': len(duplicates),
+                'matched_bytes': totals['matched_bytes'],
+                'orphan_bytes': sum(x['size'] for x in orphans)
+            }
+        }
+
+    def close(self) -> None:
+        """Releases the current payload"""
+
+        for fh in (self._zipfile, self._mapped, self.tempfile):
+            if fh:
+                fh.close()
+
+        self._zipfile = None
+        self._mapped = None
+        self.tempfile = None
+        self._data = None
+        self._records = None
+        self._members = None
+        self._report = None
+        self._totals = None
 
     def download(self, save_as: os.PathLike = None):
         """Make the API request using the parameters provided and save the
-        returned Zip file. The Zip file is stored in memory. If `save_as` is 
-        provided, the Zip file is also saved to that location on the local disk.
+        returned Zip file. Payloads up to `spool_size` bytes are stored in 
+        memory, larger ones in a temporary file. If `save_as` is provided, the 
+        Zip file is written directly to that location on the local disk and 
+        read from there. If the Gdoc has a `cache`, payloads are read from and
+        saved to the cache instead.
         """
 
-        temp = TemporaryFile('wb+')
+        # release the previous payload so that only one is held at a time
+        self.close()
+
+        if self.path:
+            # payloads from `from_zip` are read from the disk again
+            return self._load(self.path)
+
+        url = self.url
+        caching = self.cache is not None and not save_as
+
+        if caching and (cached := self.cache.get(self.parameters, api_url=self.api_url)):
+            print(json.dumps({'info': f'Using cached payload for {url}'}))
+            self.metrics.incr('cache_hits')
+
+            return self._load(cached)
+
+        if save_as:
+            temp = open(save_as, 'wb+')
+        elif caching:
+            temp = open(self.cache.temp_path(), 'wb+')
+        else:
+            temp = SpooledTemporaryFile(max_size=self.spool_size, mode='wb+')
+
         self.tempfile = temp
-        url = self.api_url + '?' + '&'.join(map(lambda x: '{}={}'.format(x[0], x[1]), self.parameters.items()))
         
-        headers = {
-            "Authorization": f"Bearer {self.token['access_token']}",
-            "Content-Type": "application/x-www-form-urlencoded",
-            "Ocp-Apim-Subscription-Key": self.ocp_apim_subscription_key
-        } if 'GDOC_API_TESTING' not in os.environ else None
+        print(json.dumps({'info': f'Getting {url}'}))
+        stats = {'url': url, 'bytes': 0, 'retries': 0, 'resumes': 0, 'started': time.time()}
+        self.request_stats.append(stats)
 
+        try:
+            with self.metrics.timer('download'):
+                response = self._get(url, stats)
 
-        print(json.dumps({'info': f'Getting {url}'}))
-        response = requests.get(url, stream=True, headers=headers)
-        
-        if response.status_code == 200:
-            print(json.dumps({'info': 'Connection established'}))
+                if response.status_code == 200:
+                    print(json.dumps({'info': 'Connection established'}))
+                    self._stream(response, url, temp, stats)
+
+            self.metrics.incr('downloads')
+            self.metrics.incr('download_bytes', stats['bytes'])
+            self.metrics.incr('download_retries', stats['retries'] + stats['resumes'])
             
-            for chunk in response.iter_content(8192):
-                temp.write(chunk)
-                
-            try:
-                self._zipfile = ZipFile(temp)
-            except BadZipFile:
-                raise Exception(f'Data returned by API cannot be read as a zip file: {response.text} : {url}')
-
-            if save_as:
-                temp.seek(0)
-                new_file = open(save_as, 'wb')
-                shutil.copyfileobj(temp, new_file)
-                new_file.close()
-        
-            # all zipfiles have export.txt containing the file metadata
-            with self._zipfile.open('export.txt') as datafile:
-                self._data = json.loads(datafile.read())
-
-            # with API DownloadFiles option, the zipfile should also include files named using data from the metadata
-            if self.parameters['DownloadFiles'] == 'Y':
-                # check that the file exists in the zipfile uisng the zipfile manifest
-                for doc in self._data:
-                    found = False
-
-                    # check both jobId and odsNo as the name of the file, as it has varied in the past 
-                    for field in ('jobId', 'odsNo'):
-                        if file_id := doc.get(field):
-                            # look for a pdf with the file id anywhere in the filename
-                            if any(filter(lambda x: file_id in x and x[-4:] == '.pdf', self.zipfile.namelist())):
-                                found = True
-
-                    if not found:
-                        print(json.dumps({'warning': f'File for {doc["symbol1"]} not found in zip file'}))
-        else:
-            raise Exception(f'API reponse not OK: {response.text} : {url}')
+            if response.status_code == 200:
+                stats['seconds'] = time.time() - stats.pop('started')
+                print(json.dumps({'info': 'Download complete', 'data': stats}))
+                    
+                try:
+                    self._open_payload(temp)
+                except BadZipFile:
+                    raise Exception(f'Data returned by API cannot be read as a zip file: {response.text} : {url}')
+
+                if caching:
+                    self.cache.add(self.parameters, temp.name, api_url=self.api_url)
+            
+                # all zipfiles have export.txt containing the file metadata
+                self._data = Records(self)
+
+                self._check_manifest()
+            else:
+                raise Exception(f'API reponse not OK: {response.text} : {url}')
+        except BaseException:
+            if caching:
+                self.close()
+
+                if os.path.exists(temp.name):
+                    os.remove(temp.name)
+
+            raise
 
         return self
 
-    def iter_files(self, callback: Callable) -> Iterator:
+    def _load(self, path: os.PathLike) -> 'Gdoc':
+        # opens a payload that is on the local disk
+        self.tempfile = open(path, 'rb')
+
+        try:
+            self._open_payload(self.tempfile)
+        except BadZipFile:
+            self.close()
+            raise Exception(f'{path} cannot be read as a zip file')
+
+        self._data = Records(self)
+        self._check_manifest()
+
+        return self
+
+    def _check_manifest(self):
+        # with API DownloadFiles option, the zipfile should also include files named using data from the metadata
+        if self.parameters['DownloadFiles'] == 'Y':
+            # check that the file exists in the zipfile uisng the zipfile manifest
+            # the records are streamed rather than kept, as they may not be needed
+            for doc in self.iter_records():
+                if self.member_for(doc) is None:
+                    print(json.dumps({'warning': f'File for {doc["symbol1"]} not found in zip file'}))
+
+    def _get(self, url: str, stats: dict, headers: dict = None) -> requests.Response:
+        response = self.session.get(url, stream=True, headers={**(self._headers() or {}), **(headers or {})}, timeout=self.timeout)
+
+        if response.status_code == 401 and 'GDOC_API_TESTING' not in os.environ:
+            # the token may have been revoked before it expired. get a new one and try once more
+            print(json.dumps({'info': 'Token not accepted, refreshing'}))
+            self.refresh_token()
+            response = self.session.get(url, stream=True, headers={**self._headers(), **(headers or {})}, timeout=self.timeout)
+
+        if retries := getattr(response.raw, 'retries', None):
+            stats['retries'] += len(retries.history)
+
+        return response
+
+    def _stream(self, response: requests.Response, url: str, fh, stats: dict) -> None:
+        # writes the response body to fh. if the connection is lost, the download is resumed from where 
+        # it stopped if the server supports range requests, otherwise the error is raised
+        while True:
+            try:
+                for chunk in response.iter_content(self.chunk_size):
+                    fh.write(chunk)
+                    stats['bytes'] += len(chunk)
+
+                return
+            except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError) as e:
+                if stats['resumes'] >= self.retries or response.headers.get('Accept-Ranges') != 'bytes':
+                    raise
+
+                stats['resumes'] += 1
+                print(json.dumps({'warning': f'Download interrupted, resuming from byte {stats["bytes"]}: {e}'}))
+                response = self._get(url, stats, headers={'Range': f'bytes={stats["bytes"]}-'})
+
+                if response.status_code == 200:
+                    # the range was ignored. start over
+                    fh.seek(0)
+                    fh.truncate()
+                    stats['bytes'] = 0
+                elif response.status_code != 206:
+                    raise Exception(f'API reponse not OK: {response.text} : {url}')
+
+    def _open_payload(self, fh) -> ZipFile:
+        # payloads that have been written to disk are memory-mapped rather than read through the file handle
+        if isinstance(fh, SpooledTemporaryFile):
+            # before Python 3.11, SpooledTemporaryFile has no `seekable`, which ZipFile needs. the
+            # underlying BytesIO, or the temporary file once it has rolled over, is used instead
+            fh = fh._file
+
+        fh.seek(0, io.SEEK_END)
+
+        with self.metrics.timer('zip_open'):
+            if self.use_mmap and fh.tell() > self.spool_size:
+                fh.flush()
+                self._mapped = _MappedFile(fh)
+                self._zipfile = ZipFile(self._mapped)
+            else:
+                self._zipfile = ZipFile(fh)
+
+        return self._zipfile
+
+    def iter_files(self, callback: Callable, workers: int = None, select: Callable = None, *,
+        single_pass: bool = False, precheck: Callable = None) -> Iterator:
         '''For each file named in the zipfile manifest, run the provided callback function using the file object 
         and its and metadata as arguments. This is implemented so that the whole zipfile does not have to be expanded
-        at once.'''
+        at once.
+        
+        If `workers` is greater than 1, the callback is run for up to that many files at a time in a thread pool.
+        Results are still yielded in the order of the zipfile manifest. An exception raised by the callback is 
+        re-raised in the position of the file that caused it.
+        
+        If `select` is provided, it is called with the metadata of each file, and files for which it returns a
+        false value are skipped without being opened. Files that are not in `self.languages` are also skipped.
+        
+        If `precheck` is provided, it is called with the ZipInfo and metadata of each selected file, and files for 
+        which it returns a false value are also skipped. The ZipInfo has the CRC and size of the file from the zip
+        central directory, so this does not read the file.
+        
+        If `single_pass` is True, the callback gets a `MemberFile`, which is decompressed once and can be read 
+        again without decompressing, instead of the zip member itself.'''
+
+        if not workers or workers < 2:
+            for name, file_data in self._iter_members(select, precheck):
+                yield self._run_callback(callback, name, file_data, single_pass)
+
+            return
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # bound the number of files in flight so that the zipfile is still read incrementally
+            pending = deque()
+
+            try:
+                for name, file_data in self._iter_members(select, precheck):
+                    pending.append(executor.submit(self._run_callback, callback, name, file_data, single_pass))
 
-        for name in self.zipfile.namelist():
-            # filenames contain a series of digits (and letters?) preceeding the file extension that can be matched to the metadata
-            match = re.search(r'(\w+)\.pdf$', name)
+                    if len(pending) >= workers * 2:
+                        yield pending.popleft().result()
 
-            if match:
-                filename = match.group(1)
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
 
-                # check both jobId and odsNo in the metadata, as the field used has varied in the past
-                if file_data := next(filter(lambda x: x['jobId'] == filename, self.data), None):
-                    yield callback(self.zipfile.open(name), file_data)
-                elif file_data := next(filter(lambda x: x['odsNo'] == filename, self.data), None):
-                    yield callback(self.zipfile.open(name), file_data)
+    def _run_callback(self, callback: Callable, name: str, file_data, single_pass: bool = False):
+        start = time.perf_counter()
+
+        try:
+            if single_pass:
+                with MemberFile(self.zipfile, name, spool_size=self.spool_size, chunk_size=self.chunk_size) as fh:
+                    return callback(fh, file_data)
+
+            return callback(self.zipfile.open(name), file_data)
+        finally:
+            self.metrics.observe('document_seconds', time.perf_counter() - start)
+            self.metrics.incr('documents')
+
+    def iter_symbols(self, symbols: list) -> Iterator['Gdoc']:
+        """Downloads the payload for each of `symbols` in turn, and yields this
+        Gdoc with that payload. The API takes one symbol per request, so this
+        is one request per distinct symbol. Only one payload is held at a time"""
+
+        for symbol in dict.fromkeys(x.strip() for x in symbols if x and x.strip()):
+            self.set_param('symbol', symbol)
+            self.download()
+
+            yield self
+
+    def _iter_members(self, select: Callable = None, precheck: Callable = None) -> Iterator:
+        # yields the name and metadata record of each selected file in the zipfile
+        for info in self.zipfile.infolist():
+            name = info.filename
+
+            if self.file_stem(name):
+                if file_data := self.record_for(name):
+                    if self.languages and file_data.get('languageId') not in self.languages:
+                        # the API has no language parameter, so other languages are skipped without being opened
+                        self.metrics.incr('files_filtered')
+                    elif (select is None or select(file_data)) and (precheck is None or precheck(info, file_data)):
+                        yield name, file_data
                 else:  
                     print(json.dumps({'warning': f'Data for "{name}" not found in zip file'}))
 
+class Record(Mapping):
+    """A read-only gDoc metadata record. The fields of export.txt are stored in
+    slots, and any others in a dict. Values that repeat across records, such as
+    symbols and languages, are shared between records. Records can be used in
+    the same way as the dicts parsed from export.txt"""
+
+    FIELDS = ('jobId', 'odsNo', 'symbol1', 'symbol2', 'languageId', 'distributionType', 'title', 'publicationDate', 'dutyStation')
+    SHARED = frozenset(('symbol1', 'symbol2', 'languageId', 'distributionType', 'publicationDate', 'dutyStation'))
+    __slots__ = FIELDS + ('_extra',)
+
+    def __init__(self, data: dict):
+        for field in self.FIELDS:
+            value = data.get(field, _MISSING)
+
+            if field in self.SHARED and type(value) is str:
+                value = sys.intern(value)
+
+            object.__setattr__(self, field, value)
+
+        object.__setattr__(self, '_extra', {k: v for k, v in data.items() if k not in self.FIELDS} or None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Record is read-only')
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            if (value := getattr(self, key)) is not _MISSING:
+                return value
+        elif self._extra and key in self._extra:
+            return self._extra[key]
+
+        raise KeyError(key)
+
+    def __iter__(self):
+        for field in self.FIELDS:
+            if getattr(self, field) is not _MISSING:
+                yield field
+
+        yield from self._extra or ()
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f'Record({dict(self)})'
+
+    def to_dict(self) -> dict:
+        return dict(self)
+
+class Records(Sequence):
+    """The metadata records of a Gdoc payload. The first iteration streams the
+    records from export.txt, and the records are kept when it finishes, so that
+    export.txt is only parsed once. An iteration that is stopped early does not
+    keep anything. Indexing or counting reads all the records."""
+
+    def __init__(self, gdoc: Gdoc):
+        self._gdoc = gdoc
+        self._list = None
+
+    def __iter__(self):
+        # the check is made when iteration starts, as list() counts the records after getting the iterator
+        if self._list is not None:
+            yield from self._list
+
+            return
+
+        records = []
+
+        for record in self._gdoc.iter_records():
+            records.append(record)
+            yield record
+
+        self._list = records
+
+    def __getitem__(self, index):
+        return self._all()[index]
+
+    def __len__(self):
+        return len(self._all())
+
+    def _all(self) -> list:
+        if self._list is None:
+            for _ in self:
+                pass
+
+        return self._list
+
+_MISSING = object()
+
+def _iter_json_array(fh, chunk_size: int = 64 * 1024) -> Iterator:
+    # incrementally parses a JSON array from a text file, yielding one element at a time
+    decoder = json.JSONDecoder()
+    buffer, pos, started = '', 0, False
+
+    while True:
+        chunk = fh.read(chunk_size)
+        buffer, pos = buffer[pos:] + chunk, 0
+
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+
+            if pos == len(buffer):
+                break
+            elif not started:
+                if buffer[pos] != '[':
+                    raise ValueError('export.txt does not contain a JSON array')
+
+                started, pos = True, pos + 1
+            elif buffer[pos] == ']':
+                return
+            else:
+                try:
+                    element, pos = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if not chunk:
+                        raise
+
+                    # the element continues in the next chunk
+                    break
+
+                yield element
+
+        if not chunk:
+            raise ValueError('Unexpected end of export.txt')
+
+class AsyncGdoc(GdocClient):
+    """Fetches the payloads for many queries concurrently. Each query is a dict
+    of API parameters that are combined with the ones set on this client. The 
+    payloads are Gdoc objects sharing this client's token and connection pool,
+    so they are processed the same way as a single Gdoc.
+
+    Usage:
+        client = AsyncGdoc(client_id=..., concurrency=4)
+        client.set_param('DownloadFiles', 'Y')
+        queries = [{'dutyStation': x, 'dateFrom': '2021-01-03', 'dateTo': '2021-01-03'} for x in ('NY', 'GE')]
+
+        def todo(g):
+            return list(g.iter_files(callback))
+
+        results = client.run(queries, todo)
+    """
+
+    def __init__(self, *, concurrency: int = 4, **kwargs):
+        kwargs.setdefault('pool_size', max(concurrency, POOL_SIZE))
+        super().__init__(**kwargs)
+        self.concurrency = concurrency
+
+    def query(self, **parameters) -> Gdoc:
+        """Returns a Gdoc for the given API parameters"""
+
+        g = Gdoc(**self.options)
+
+        for name, value in {**self.parameters, **parameters}.items():
+            g.set_param(name, value)
+
+        return g
+
+    async def process(self, queries: list, handler: Callable) -> list:
+        """Downloads the payload for each query and runs `handler` with its Gdoc
+        as the argument. At most `concurrency` payloads are downloaded or 
+        handled at a time, and each payload is released once it has been
+        handled. Returns the handler's return value for each query in the order
+        of `queries`, or the exception raised if the query failed."""
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(query):
+            g = self.query(**query)
+
+            try:
+                async with semaphore:
+                    await asyncio.to_thread(g.download)
+
+                    return await asyncio.to_thread(handler, g)
+            finally:
+                g.close()
+
+        return await asyncio.gather(*map(run, queries), return_exceptions=True)
+
+    def run(self, queries: list, handler: Callable) -> list:
+        """Runs `process` in a new event loop"""
+
+        return asyncio.run(self.process(queries, handler))
+
+class MemberFile(io.RawIOBase):
+    """A zip member that is decompressed once, into a spooled temporary file,
+    with its MD5 checksum computed as it is decompressed. The file can then be
+    read and seeked any number of times without decompressing it again. `info`
+    is the member's ZipInfo, with its CRC and size.
+
+    Usage:
+        with MemberFile(g.zipfile, 'N2100001.pdf') as fh:
+            fh.md5
+            fh.read()
+    """
+
+    def __init__(self, zipfile: ZipFile, name: str, *, spool_size: int = SPOOL_SIZE, chunk_size: int = CHUNK_SIZE):
+        self.info = zipfile.getinfo(name) if isinstance(name, str) else name
+        self.name = self.info.filename
+        self._fh = SpooledTemporaryFile(max_size=spool_size)
+        hasher = hashlib.md5()
+
+        # the member's CRC is checked by the zipfile module when the end is reached
+        with zipfile.open(self.info) as member:
+            while chunk := member.read(chunk_size):
+                hasher.update(chunk)
+                self._fh.write(chunk)
+
+        self.md5 = hasher.hexdigest()
+        self._fh.seek(0)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        return self._fh.read(size if size is not None else -1)
+
+    def readinto(self, b):
+        data = self._fh.read(len(b))
+        b[:len(data)] = data
+
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._fh.seek(offset, whence)
+
+    def tell(self):
+        return self._fh.tell()
+
+    def close(self):
+        if not self.closed:
+            self._fh.close()
+
+        super().close()
+
+class _MappedFile(io.RawIOBase):
+    # read-only, seekable file object over a memory map of an open file
+    def __init__(self, fh):
+        self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        return self._map.read(size if size is not None and size >= 0 else None)
+
+    def readinto(self, b):
+        data = self._map.read(len(b))
+        b[:len(data)] = data
+
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._map.seek(offset, whence)
+
+        return self._map.tell()
+
+    def tell(self):
+        return self._map.tell()
+
+    def close(self):
+        if not self.closed:
+            self._map.close()
+
+        super().close()
+
 class Schema():
     pass
@@ -0,0 +1,124 @@
+import os, json, time, hashlib, uuid
+from typing import Optional
+from datetime import datetime, timezone
+from threading import Lock
+
+class PayloadCache():
+    """On-disk cache of gDoc API payloads, keyed by the API URL and parameters,
+    so that a cache directory can be shared by environments.
+
+    Payloads are evicted least recently used first once the cache is larger
+    than `max_bytes`. Documents may still be added for recent dates, so payloads
+    for queries with a dateTo within `volatile_days` of today (or without a
+    dateTo) expire after `volatile_ttl` seconds. Others expire after `ttl`
+    seconds, or never if `ttl` is None.
+
+    Usage:
+        g = Gdoc(..., cache=PayloadCache('/tmp/gdoc-cache'))
+    """
+
+    def __init__(self, path: os.PathLike, *, max_bytes: int = 10 * 1024 ** 3, ttl: float = None,
+        volatile_days: int = 7, volatile_ttl: float = 3600):
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.volatile_days = volatile_days
+        self.volatile_ttl = volatile_ttl
+        self.lock = Lock()
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def key(parameters: dict, api_url: str = None) -> str:
+        """Returns the cache key for a set of API parameters sent to `api_url`"""
+
+        canonical = {name: str(value).strip() for name, value in parameters.items()}
+
+        return hashlib.sha256(json.dumps([api_url, canonical], sort_keys=True).encode()).hexdigest()
+
+    def get(self, parameters: dict, *, api_url: str = None) -> Optional[str]:
+        """Returns the path of the cached payload for the parameters, or None if
+        there is no unexpired payload. Requests without files can be served from
+        the payload of the same request with files"""
+
+        candidates = [parameters]
+
+        if parameters.get('DownloadFiles') != 'Y':
+            candidates.append({**parameters, 'DownloadFiles': 'Y'})
+
+        for params in candidates:
+            path = self._path(params, api_url)
+
+            try:
+                # the modification time is when the payload was added, the access time when it was last used
+                created = os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+
+            if self._expired(params, created):
+                self._remove(path)
+                continue
+
+            os.utime(path, (time.time(), created))
+
+            return path
+
+    def temp_path(self) -> str:
+        """Returns a path in the cache directory to download a payload to before
+        it is added"""
+
+        return os.path.join(self.path, f'.{uuid.uuid4().hex}.tmp')
+
+    def add(self, parameters: dict, temp_path: os.PathLike, *, api_url: str = None) -> str:
+        """Moves the payload at `temp_path` into the cache and returns its new
+        path. The payload is not copied, so it can stay open while it is added"""
+
+        path = self._path(parameters, api_url)
+        os.replace(temp_path, path)
+        self.evict(keep=path)
+
+        return path
+
+    def evict(self, keep: str = None) -> None:
+        """Removes the least recently used payloads until the cache is no larger
+        than `max_bytes`"""
+
+        with self.lock:
+            entries = []
+
+            for entry in os.scandir(self.path):
+                if entry.name.endswith('.zip'):
+                    stat = entry.stat()
+                    entries.append((stat.st_atime, stat.st_size, entry.path))
+
+            total = sum(size for _, size, _ in entries)
+
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                elif path != keep:
+                    self._remove(path)
+                    total -= size
+
+    def _path(self, parameters: dict, api_url: str = None) -> str:
+        return os.path.join(self.path, self.key(parameters, api_url) + '.zip')
+
+    def _expired(self, parameters: dict, created: float) -> bool:
+        ttl = self.volatile_ttl if self._volatile(parameters) else self.ttl
+
+        return ttl is not None and time.time() - created > ttl
+
+    def _volatile(self, parameters: dict) -> bool:
+        try:
+            date_to = datetime.strptime(parameters.get('dateTo'), '%Y-%m-%d').date()
+        except (TypeError, ValueError):
+            return True
+
+        return (datetime.now(timezone.utc).date() - date_to).days < self.volatile_days
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -1,50 +1,101 @@
-import sys, re, json, boto3, os
+import sys, re, json, os, time, hashlib, multiprocessing
+from threading import Lock
+from concurrent.futures import ProcessPoolExecutor
 from argparse import ArgumentParser
-from datetime import datetime, timezone
+from typing import Iterator, Callable
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from collections import Counter
 from dlx import DB as DLX
-from dlx.marc import Bib, Query, Condition, Or
+from dlx.marc import Bib, BibSet, Query, Condition, Or
 from dlx.file import S3, File, Identifier, FileExists, FileExistsConflict
-from gdoc_api import Gdoc
+from gdoc_api import Gdoc, PayloadCache
+from gdoc_api.metrics import Metrics
+from gdoc_api.scripts.gdoc_file_index import FileIndex
+
+GDOC_SECRETS = ('token_url', 'api_url', 'ocp_apim_subscription_key', 'client_id', 'client_secret', 'scope')
+
+class SSMCache():
+    """Process-wide cache of AWS SSM parameter values. Missing parameters are
+    fetched in one `get_parameters` call and kept for `ttl` seconds, so that
+    warm Lambda invocations and repeated runs in the same process do not call
+    SSM again. The boto3 client is created on first use."""
+
+    def __init__(self, ttl: float = 900):
+        self.ttl = ttl
+        self.values = {}
+        self.client = None
+        self.lock = Lock()
+
+    def get(self, names) -> dict:
+        """Returns a dict of the values of the parameters `names`"""
+
+        names = list(names)
+
+        with self.lock:
+            now = time.time()
+            missing = [x for x in names if x not in self.values or now - self.values[x][1] > self.ttl]
+
+            if missing:
+                if self.client is None:
+                    import boto3
+                    self.client = boto3.client('ssm')
+
+                # get_parameters accepts up to 10 names at a time
+                for i in range(0, len(missing), 10):
+                    response = self.client.get_parameters(Names=missing[i:i + 10])
+
+                    if response['InvalidParameters']:
+                        raise Exception(f'SSM parameters not found: {response["InvalidParameters"]}')
+
+                    for param in response['Parameters']:
+                        self.values[param['Name']] = (param['Value'], now)
+
+            return {x: self.values[x][0] for x in names}
+
+    def clear(self) -> None:
+        with self.lock:
+            self.values.clear()
+
+SSM_CACHE = SSMCache(ttl=float(os.getenv('GDOC_SSM_TTL', 900)))
+
+# the arguments that can be passed to `run`
+PARAMS = ('station', 'date', 'date_from', 'date_to', 'window_size', 'from_zip', 'processes', 'symbol', 'language', 'overwrite', 'recursive', 'connection_string', 'database', 's3_bucket', 'save_as', 'data_only', 'create_bibs', 'workers', 'incremental', 'cache_dir', 'cache_size', 'metrics_log')
+FLAGS = ('overwrite', 'recursive', 'data_only', 'create_bibs', 'incremental', 'metrics_log')
 
 def get_args(**kwargs):
     parser = ArgumentParser(prog='gdoc-dlx')
     
     r = parser.add_argument_group('required')
     r.add_argument('--station', required=True, choices=['NY', 'GE', 'Vienna', 'Beirut', 'Bangkok', 'Nairobi'])
-    r.add_argument('--date', required=True, help='YYYY-MM-DD')
+    r.add_argument('--date', help='YYYY-MM-DD. required unless --date_from is used')
 
     nr = parser.add_argument_group('not required')
-    nr.add_argument('--symbol', help='get only the files for the specified symbol')
-    nr.add_argument('--language', choices=['A', 'C', 'E', 'F', 'R', 'S', 'G'], help='get only the files for the specified language')
+    nr.add_argument('--symbol', nargs='+', help='get only the files for the specified symbols')
+    nr.add_argument('--language', nargs='+', choices=['A', 'C', 'E', 'F', 'R', 'S', 'G'], help='get only the files for the specified languages')
     nr.add_argument('--overwrite', action='store_true', help='ignore conflicts and overwrite exisiting DLX data')
     nr.add_argument('--recursive', action='store_true', help='download the files one synbol at a time')
     nr.add_argument('--save_as', help='save the payload (zip file) to the specified location and quit without uploading files to DLX')
-    nr.add_argument('--data_only', action='store_true', help='get only the data without downloading the files and print it to STDOUT')
+    nr.add_argument('--data_only', action='store_true', help='get only the data without downloading the files and print it to STDOUT, one JSON record per line')
     nr.add_argument('--create_bibs', action='store_true', help='Create bib record for symbol if it doesn\'t exist')
+    nr.add_argument('--workers', type=int, default=1, help='number of files to upload at a time')
+    nr.add_argument('--cache_dir', help='cache API payloads in this directory and reuse them for identical requests')
+    nr.add_argument('--cache_size', type=int, default=10240, help='maximum size of the payload cache in MB')
+    nr.add_argument('--metrics_log', action='store_true', help='also write the run\'s metrics summary to the gdoc_log collection')
+    nr.add_argument('--date_from', help='YYYY-MM-DD. run for a range of dates, starting on this date, instead of --date')
+    nr.add_argument('--date_to', help='YYYY-MM-DD. last date of the range. defaults to --date_from')
+    nr.add_argument('--window_size', type=int, default=5000, help='maximum number of documents to run at a time in a date range. larger windows are split')
+    nr.add_argument('--from_zip', help='import from a payload saved with --save_as, or from each .zip file in a directory, instead of calling the API')
+    nr.add_argument('--processes', type=int, help='number of zip files to import at a time with --from_zip. defaults to the number of CPUs')
+    nr.add_argument('--incremental', action='store_true', help='download and import only the documents that are new or have changed since they were last imported')
  
     c = parser.add_argument_group(
         title='credentials', 
         description='these arguments are supplied by AWS SSM if AWS credentials are configured',
     )
 
-    # get from AWS if not provided
-    ssm = boto3.client('ssm')
-
-    def param(name: str) -> str:
-        # returns the string value of the parameter in aws ssm.
-        # note this may be a json string
-        return ssm.get_parameter(Name=name)['Parameter']['Value']
-    
     # dlx env
-    dlx_env = os.getenv("DLX_ENV")
-    valid = ('testing', 'dev', 'uat', 'prod')
-    
-    if dlx_env not in valid:
-        raise Exception(f'Environment variable "DLX_ENV" must be one of {valid}')
-        
-    c.add_argument('--connection_string', default='dummy' if dlx_env == 'testing' else param(f'{dlx_env}ISSU-admin-connect-string'))
-    c.add_argument('--database', default='undlFiles' if dlx_env in ['prod', 'uat'] else 'dev_undlFiles')
-    c.add_argument('--s3_bucket', default='undl-files' if dlx_env == 'prod' else 'dev-undl-files')
+    dlx_env = get_dlx_env()
 
     # gDoc env - can be "qa" or "prod"
     gdoc_env = os.getenv("GDOC_ENV")
@@ -52,190 +103,835 @@ def get_args(**kwargs):
         
     if gdoc_env not in valid:
         raise Exception(f'Environment variable "GDOC_ENV" must be one of {valid}')
+
+    # get from AWS if not provided. the parameters are fetched in one call and cached for the process
+    argv = process_kwargs(**kwargs) if kwargs else sys.argv[1:]
+    provided = lambda name: any(x == f'--{name}' or x.startswith(f'--{name}=') for x in argv)
+    names = {}
+
+    if dlx_env != 'testing' and not provided('connection_string'):
+        names['connection_string'] = connection_param(dlx_env)
+
+    if not provided('from_zip') and not all(provided(f'gdoc_{x}') for x in GDOC_SECRETS):
+        names['gdoc'] = f'gdoc-{gdoc_env}-api-secrets'
+
+    params = SSM_CACHE.get(names.values())
+    
+    c.add_argument('--connection_string', default='dummy' if dlx_env == 'testing' else params.get(names.get('connection_string')))
+    c.add_argument('--database', default=default_database(dlx_env))
+    c.add_argument('--s3_bucket', default='undl-files' if dlx_env == 'prod' else 'dev-undl-files')
     
     # args for the gdoc env params are stored as a json string 
-    gdoc_args = json.loads(param(f'gdoc-{gdoc_env}-api-secrets'))
+    gdoc_args = json.loads(params[names['gdoc']]) if 'gdoc' in names else {}
     
-    c.add_argument('--gdoc_token_url', default=gdoc_args['token_url'])
-    c.add_argument('--gdoc_api_url', default=gdoc_args['api_url'])
-    c.add_argument('--gdoc_ocp_apim_subscription_key', default=gdoc_args['ocp_apim_subscription_key'])
-    c.add_argument('--gdoc_client_id', default=gdoc_args['client_id'])
-    c.add_argument('--gdoc_client_secret', default=gdoc_args['client_secret'])
-    c.add_argument('--gdoc_scope', default=gdoc_args['scope'])
+    c.add_argument('--gdoc_token_url', default=gdoc_args.get('token_url'))
+    c.add_argument('--gdoc_api_url', default=gdoc_args.get('api_url'))
+    c.add_argument('--gdoc_ocp_apim_subscription_key', default=gdoc_args.get('ocp_apim_subscription_key'))
+    c.add_argument('--gdoc_client_id', default=gdoc_args.get('client_id'))
+    c.add_argument('--gdoc_client_secret', default=gdoc_args.get('client_secret'))
+    c.add_argument('--gdoc_scope', default=gdoc_args.get('scope'))
 
     # Deprecated, replaced by client ID and secret
     #c.add_argument('--gdoc_api_username', default=json.loads(param('gdoc-{env}-api-secrets'))['username'])
     #c.add_argument('--gdoc_api_password', default=json.loads(param('gdoc-{env}-api-secrets'))['password'])
 
-    if kwargs:
-        process_kwargs(**kwargs)
-
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
-def process_kwargs(**kwargs):
+def process_kwargs(**kwargs) -> list:
     """If being imported as a function, process kwargs into command line args 
-    so they can be parsed by argparse"""
-
-    sys.argv = [sys.argv[0]]
-    params = ('station', 'date', 'symbol', 'language', 'overwrite', 'recursive', 'connection_string', 'database', 's3_bucket', 'save_as', 'data_only')
+    so they can be parsed by argparse. The args are returned rather than set in
+    sys.argv so that runs in separate threads do not interfere"""
 
+    argv = []
     for param in ('station', 'date'):
-        if param not in params:
+        if param not in PARAMS:
             raise Exception(f'Required param {param}')
 
     for param, arg in kwargs.items():
-        if param not in params:
+        if param not in PARAMS:
             raise Exception(f'Invalid argument: "{param}"')
 
-        if param in ('overwrite', 'recursive', 'data_only'):
+        if param in FLAGS:
             # boolean args
             if arg == True:
-                sys.argv.append(f'--{param}')
+                argv.append(f'--{param}')
+        elif isinstance(arg, (list, tuple, set)):
+            # list args
+            argv += [f'--{param}', *arg]
         else:
-            sys.argv.append(f'--{param}={arg}')
+            argv.append(f'--{param}={arg}')
+
+    return argv
 
 def set_log():
     pass
+
+def get_dlx_env() -> str:
+    dlx_env = os.getenv("DLX_ENV")
+    valid = ('testing', 'dev', 'uat', 'prod')
     
+    if dlx_env not in valid:
+        raise Exception(f'Environment variable "DLX_ENV" must be one of {valid}')
+
+    return dlx_env
+
+def connection_param(dlx_env: str) -> str:
+    # the name of the SSM parameter with the DLX connection string
+    return f'{dlx_env}ISSU-admin-connect-string'
+
+def default_database(dlx_env: str) -> str:
+    return 'undlFiles' if dlx_env in ['prod', 'uat'] else 'dev_undlFiles'
+
+def dlx_connection(connection_string: str = None, database: str = None) -> tuple:
+    """Returns the DLX connection string and database for DLX_ENV, for scripts
+    that only need DLX. The connection string is taken from AWS SSM if it is
+    not provided"""
+
+    dlx_env = get_dlx_env()
+
+    if not connection_string:
+        connection_string = 'dummy' if dlx_env == 'testing' else SSM_CACHE.get([connection_param(dlx_env)])[connection_param(dlx_env)]
+
+    return connection_string, database or default_database(dlx_env)
+
+class LogBuffer():
+    """Buffers gdoc_log documents and writes them to the database in bulk. The
+    buffer is written when it reaches `size` documents, when `interval` seconds
+    have passed since the last write, and when the context exits, including on
+    exceptions.
+    
+    Usage:
+        with LogBuffer(DLX.handle['gdoc_log'], metrics=g.metrics) as log:
+            log.insert({...})
+    """
+
+    def __init__(self, collection, *, size: int = 100, interval: float = 10, metrics: Metrics = None):
+        self.collection = collection
+        self.metrics = metrics or Metrics()
+        self.size = size
+        self.interval = interval
+        self.buffer = []
+        self.lock = Lock() # the buffer is shared by the upload worker threads
+        self.flushed = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    def insert(self, doc: dict) -> None:
+        with self.lock:
+            self.buffer.append(doc)
+
+            if len(self.buffer) >= self.size or time.monotonic() - self.flushed >= self.interval:
+                self._flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        docs, self.buffer = self.buffer, []
+        self.flushed = time.monotonic()
+
+        if docs:
+            try:
+                # unordered so that one failed document does not prevent the rest from being written
+                with self.metrics.timer('gdoc_log'):
+                    self.collection.insert_many(docs, ordered=False)
+            except Exception as e:
+                print(json.dumps({'error': 'gdoc_log write failed: ' + '; '.join(re.split('[\r\n]', str(e)))}))
+    
+PROGRESS_INTERVAL = 100 # files between progress logs
+
+LANGUAGES = {'A': 'AR', 'C': 'ZH', 'E': 'EN', 'F': 'FR', 'R': 'RU', 'S': 'ES', 'G': 'DE'}
+
+def fingerprint(record: dict) -> str:
+    """Returns a hash of all the fields of a gDoc metadata record, which changes
+    if the document is revised"""
+
+    return hashlib.sha1(json.dumps(dict(record), sort_keys=True, default=str).encode()).hexdigest()
+
+def excluded(data) -> str:
+    """Returns the reason that a document is never imported ("RES" or
+    "JOURNAL"), or None"""
+
+    if data['distributionType'] == 'RES':
+        return 'RES'
+
+    if any([re.search(r'JOURNAL', x) for x in (data['symbol1'], data['symbol2'] or '')]):
+        return 'JOURNAL'
+
+def plan_incremental(data) -> list:
+    """Returns the metadata records that are new or have changed since they were
+    last imported. A record is unchanged if gdoc_log has an entry for the same
+    fingerprint that was imported, already in the system or skipped by the file
+    index. Documents whose file was not in the payload stay changed, as the
+    file may be added later without changing the metadata.
+    Documents that have no fingerprinted log entries yet are unchanged if DLX
+    has a file for their symbols and language. Documents that are never
+    imported are left out."""
+
+    data = [x for x in data if not excluded(x)]
+    prints = {fingerprint(x): x for x in data}
+    col = DLX.handle['gdoc_log']
+    
+    for field in ('gdoc_fingerprint', 'gdoc_job_id', 'gdoc_ods_no'):
+        col.create_index(field)
+
+    done, logged = set(), set()
+
+    for entry in col.find({'gdoc_fingerprint': {'$in': list(prints)}}, projection={'gdoc_fingerprint': 1, 'imported': 1, 'message': 1}):
+        if entry['imported'] or (entry.get('message') or {}).get('info') in ('Already in the system', 'Relinked', 'Unchanged'):
+            done.add(entry['gdoc_fingerprint'])
+
+    # documents that have been logged with a fingerprint before. if the fingerprint is not done, they have changed
+    ids = list(filter(None, [x.get(field) for x in data for field in ('jobId', 'odsNo')]))
+
+    for entry in col.find({'$or': [{'gdoc_job_id': {'$in': ids}}, {'gdoc_ods_no': {'$in': ids}}]}, projection={'gdoc_job_id': 1, 'gdoc_ods_no': 1}):
+        logged.update([entry.get('gdoc_job_id'), entry.get('gdoc_ods_no')])
+
+    legacy = {fp for fp, x in prints.items() if fp not in done and not ({x.get('jobId'), x.get('odsNo')} - {None, ''}) & logged}
+    in_dlx = set()
+
+    if legacy:
+        symbols = list(set(gdoc_symbols(prints[fp] for fp in legacy)))
+        query = {'identifiers': {'$elemMatch': {'type': 'symbol', 'value': {'$in': symbols}}}}
+
+        for f in DLX.handle['files'].find(query, projection={'identifiers': 1, 'languages': 1}):
+            for identifier in f['identifiers']:
+                for lang in f['languages']:
+                    in_dlx.add((identifier['value'], lang))
+
+    changed = []
+
+    for fp, record in prints.items():
+        if fp in done:
+            continue
+        elif fp in legacy and (record.get('symbol1'), LANGUAGES.get(record.get('languageId'))) in in_dlx:
+            continue
+
+        changed.append(record)
+
+    print(json.dumps({'info': f'{len(changed)} of {len(data)} documents are new or changed'}))
+
+    return changed
+
+def find_bib_symbols(symbols, *, batch_size: int = 1000) -> set:
+    """Returns the set of symbols in 191$a or 191$z of existing bib records,
+    looked up for all of `symbols` in batches"""
+
+    symbols, found = list(dict.fromkeys(filter(None, symbols))), set()
+
+    for i in range(0, len(symbols), batch_size):
+        batch = symbols[i:i + batch_size]
+        query = Query(Or(Condition('191', {'a': {'$in': batch}}), Condition('191', {'z': {'$in': batch}})))
+
+        for bib in BibSet.from_query(query, projection={'191': 1}):
+            found.update(bib.get_values('191', 'a'), bib.get_values('191', 'z'))
+
+    return found
+
+def gdoc_symbols(data) -> Iterator:
+    # symbol1 and symbol2 of each metadata record
+    for record in data:
+        yield record.get('symbol1')
+
+        if (symbol2 := record.get('symbol2')) and not symbol2.isspace():
+            yield symbol2
+
+class BibBatch():
+    """Collects the bib records to create for a run, so that they are created
+    in one stage after the files are imported instead of in between uploads.
+    Symbols are looked up in DLX once per batch, and a symbol gets at most one
+    new bib record, with the titles of all the documents added for it.
+
+    Usage:
+        bibs = BibBatch(metrics=g.metrics)
+        bibs.lookup(gdoc_symbols(g.data))
+        bibs.add(['A/RES/1'], ['Title', 'Titre'])
+        bibs.commit()
+    """
+
+    def __init__(self, *, metrics: Metrics = None):
+        self.metrics = metrics or Metrics()
+        self.existing = set() # symbols with a bib record
+        self.checked = set() # symbols looked up in DLX
+        self.pending = {} # first symbol -> symbols and titles of the bib to create
+        self.lock = Lock()
+
+    def lookup(self, symbols) -> None:
+        """Looks up the symbols that have not been looked up yet"""
+
+        with self.lock:
+            new = set(filter(None, symbols)) - self.checked
+
+            if new:
+                with self.metrics.timer('bib_lookup'):
+                    self.existing.update(find_bib_symbols(new))
+
+                self.checked.update(new)
+
+    def add(self, symbols: list, titles: list) -> bool:
+        """Adds a bib record to create for `symbols`, unless one exists or is
+        already pending, in which case the titles are added to the pending one.
+        Returns True if a new bib record was added"""
+
+        with self.lock:
+            if pending := self.pending.get(symbols[0]):
+                pending['titles'].extend(titles)
+            elif any(symbol in self.existing for symbol in symbols):
+                print(json.dumps({'info': f'Bib record for {symbols} already exists'}))
+            else:
+                self.pending[symbols[0]] = {'symbols': symbols, 'titles': list(titles)}
+                # later files for any of the symbols are added to this bib
+                self.existing.update(symbols)
+
+                return True
+
+        return False
+
+    def commit(self) -> dict:
+        """Creates the pending bib records. A record that fails is reported
+        and does not stop the others. Returns the number of bibs created and
+        failed"""
+
+        with self.lock:
+            pending, self.pending = list(self.pending.values()), {}
+
+        created = failed = 0
+
+        with self.metrics.timer('bibs'):
+            for item in pending:
+                bib = Bib()
+
+                for symbol in item['symbols']:
+                    bib.set('191', 'a', symbol, address='+')
+
+                bib.set('245', 'a', 'Work in progress')
+
+                for title in dict.fromkeys(filter(None, item['titles'])):
+                    bib.set('246', 'a', title, address='+')
+
+                try:
+                    bib.commit(user='gDoc import')
+                    created += 1
+                    print(json.dumps({'info': 'Created new bib', 'data': {'record_id': bib.id, 'symbols': item['symbols']}}))
+                except Exception as e:
+                    failed += 1
+                    print(json.dumps({'error': '; '.join(re.split('[\r\n]', str(e))), 'data': {'symbols': item['symbols']}}))
+
+        self.metrics.incr('bibs_created', created)
+        self.metrics.incr('bibs_failed', failed)
+
+        return {'bibs_created': created, 'bibs_failed': failed}
+
+_connected = {}
+_connect_lock = Lock()
+
+def connect(args) -> None:
+    """Connects to DLX and S3, reusing the connections if they are already open
+    for the same database and bucket"""
+
+    with _connect_lock:
+        if _connected.get('dlx') != (args.connection_string, args.database):
+            DLX.connect(args.connection_string, database=args.database)
+            _connected['dlx'] = (args.connection_string, args.database)
+
+        if _connected.get('s3') != args.s3_bucket:
+            S3.connect(bucket=args.s3_bucket) # not needed since AWS credentials are already in place
+            _connected['s3'] = args.s3_bucket
+
+def gdoc_session():
+    """Returns the HTTP session shared by the runs in this process, so that
+    connections to the gDoc API are kept open across runs"""
+
+    with _connect_lock:
+        if 'session' not in _connected:
+            _connected['session'] = Gdoc.new_session()
+
+        return _connected['session']
+
 ###
 
 def run(**kwargs): # *, station, date, symbol=None, language=None, overwrite=None, recursive=None, connection_string=None, database=None, s3_bucket=None, create_bibs=None):
-    args = get_args(**kwargs)
+    metrics = Metrics()
+    args, g = init(kwargs, metrics)
+
+    if args.from_zip:
+        if args.data_only or args.save_as or args.recursive or args.incremental or args.date_from:
+            raise Exception('--from_zip not compatible with --data_only, --save_as, --recursive, --incremental or --date_from')
+
+        return import_zips(args, g.metrics)
+    elif args.data_only or args.save_as:
+        if args.date_from:
+            raise Exception('--data_only and --save_as not compatible with --date_from')
+        elif args.recursive or args.incremental:
+            raise Exception('--data_only and --save_as not compatible with --recursive or --incremental')
+        elif args.symbol and len(args.symbol) > 1:
+            raise Exception('--data_only and --save_as not compatible with more than one --symbol')
+
+        if args.data_only:
+            g.set_param('DownloadFiles', 'N')
+
+            # stream the records as newline-delimited JSON, without keeping them
+            for record in g.iter_records():
+                print(json.dumps(dict(record)))
+        else:
+            print(f'Saving payload to file path: {args.save_as}')
+            g.download(save_as=args.save_as)
+            print('Done')
 
-    if not args.date and not args.symbol:
-        raise Exception('--symbol or --date required')
+        exit()
+
+    # the file index is loaded once for the run and passed down to the imports
+    with file_index(args, g.metrics) as index:
+        if args.date_from:
+            # plan the range as windows that are small enough for one run, then run them with the same session
+            windows = plan_windows(g, args.date_from, args.date_to or args.date_from, args.window_size)
+            counts, symbols = Counter(), 0
+
+            for date_from, date_to, records in windows:
+                print(json.dumps({'info': 'Running window', 'data': {'date_from': date_from, 'date_to': date_to, 'documents': len(records)}}))
+                g.set_param('dateFrom', date_from)
+                g.set_param('dateTo', date_to)
+                # the window's metadata was downloaded by the planner
+                window_counts, window_symbols = import_recursive(g, args, index, records=records)
+                counts.update(window_counts)
+                symbols += window_symbols
+
+            summary = {'symbols': symbols, 'windows': len(windows), 'date_from': args.date_from, 'date_to': args.date_to or args.date_from}
+        elif args.recursive or args.incremental:
+            counts, symbols = import_recursive(g, args, index)
+            summary = {'symbols': symbols}
+        elif args.symbol and len(args.symbol) > 1:
+            counts = import_symbols(g, args, args.symbol, index=index)
+            summary = {'symbols': len(set(args.symbol))}
+        else:
+            g.set_param('DownloadFiles', 'Y')
+
+            with LogBuffer(DLX.handle['gdoc_log'], metrics=g.metrics) as log:
+                counts = import_files(g, args, log, index=index)
+
+            summary = {}
+
+    g.close()
+
+    return summarize(args, counts, g.metrics, **summary)
+
+@contextmanager
+def file_index(args, metrics: Metrics) -> Iterator[FileIndex]:
+    """Loads the file index for a run, and writes the index updates that are
+    still buffered when the run ends. Yields None with --overwrite, as the
+    files are then imported without looking them up"""
+
+    if args.overwrite:
+        yield None
+    else:
+        with FileIndex.load(metrics=metrics) as index:
+            yield index
+
+def import_recursive(g: Gdoc, args, index: FileIndex = None, records: list = None) -> tuple:
+    """Gets the metadata for the current query, unless its `records` are
+    provided, then downloads and imports the files one symbol at a time.
+    Returns the counts and the number of symbols"""
+
+    # get the metadata once, then download the files for each indvidual symbol using the same session
+    g.set_param('symbol', query_symbol(args))
+
+    if records is None:
+        g.set_param('DownloadFiles', 'N')
+        g.download()
+        records = g.data
+
+    select = None
+
+    if args.incremental:
+        # only request the symbols that have new or changed documents, and only import those documents
+        select = select_ids(changed_ids(records))
+        symbols = list(dict.fromkeys(data['symbol1'] for data in records if select(data)))
+    else:
+        symbols = list(dict.fromkeys(data['symbol1'] for data in records))
+
+    if args.symbol:
+        symbols = [x for x in symbols if x in args.symbol]
+
+    planned = set(symbols)
+    documents = sum(1 for data in records if data['symbol1'] in planned and (select is None or select(data)))
+    print(json.dumps({'info': 'Run plan', 'data': {'station': args.station, 'date_from': g.parameters['dateFrom'], 'date_to': g.parameters['dateTo'], 'symbols': len(symbols), 'documents': documents}}))
+
+    # look up the existing bibs for the whole run at once
+    if args.create_bibs:
+        bibs = BibBatch(metrics=g.metrics)
+        bibs.lookup(gdoc_symbols(records))
+    else:
+        bibs = None
+
+    return import_symbols(g, args, symbols, bibs, select=select, index=index), len(symbols)
+
+def plan_windows(g: Gdoc, date_from: str, date_to: str, max_documents: int) -> list:
+    """Splits the range from `date_from` to `date_to` (YYYY-MM-DD) into
+    windows of no more than `max_documents` documents, using the metadata. A
+    window that is too large is split in half, down to single days. Returns
+    (date_from, date_to, records) for each window that has documents, so that
+    the windows can be run without getting their metadata again"""
+
+    start, end = (datetime.strptime(x, '%Y-%m-%d') for x in (date_from, date_to))
+
+    if end < start:
+        raise Exception('--date_to must not be before --date_from')
+
+    g.set_param('DownloadFiles', 'N')
+    pending, windows = [(start, end)], []
+
+    with g.metrics.timer('plan_windows'):
+        while pending:
+            start, end = pending.pop()
+            g.set_param('dateFrom', start.strftime('%Y-%m-%d'))
+            g.set_param('dateTo', end.strftime('%Y-%m-%d'))
+            g.download()
+            documents = len(g.data)
+
+            if documents > max_documents and end > start:
+                middle = start + (end - start) / 2
+                middle = datetime(middle.year, middle.month, middle.day)
+                # the earlier half is popped first
+                pending += [(middle + timedelta(days=1), end), (start, middle)]
+            elif documents:
+                windows.append((g.parameters['dateFrom'], g.parameters['dateTo'], list(g.data)))
+
+    g.close()
+    print(json.dumps({'info': f'Planned {len(windows)} windows', 'data': {'date_from': date_from, 'date_to': date_to, 'documents': sum(len(x[2]) for x in windows)}}))
+
+    return windows
+
+def import_zips(args, metrics: Metrics) -> dict:
+    """Imports the files from the saved payload at `args.from_zip`, or from
+    each .zip file in that directory. Several zip files are imported at a time
+    in separate processes. Returns the summary of all the zip files"""
+
+    if os.path.isdir(args.from_zip):
+        paths = sorted(os.path.join(args.from_zip, x) for x in os.listdir(args.from_zip) if x.endswith('.zip'))
+    else:
+        paths = [args.from_zip]
+
+    if len(paths) == 1:
+        return summarize(args, import_zip(args, paths[0], metrics), metrics, zips=1)
+
+    # each zip file is run in its own process, with its own connections. spawned processes do not
+    # inherit the open connections, which are not safe to use across a fork
+    kwargs = {name: value for name, value in vars(args).items() if name in PARAMS and value not in (None, False)}
+    counts = Counter()
+
+    with ProcessPoolExecutor(max_workers=args.processes or os.cpu_count(), mp_context=multiprocessing.get_context('spawn')) as executor:
+        for result in executor.map(_import_zip, [{**kwargs, 'from_zip': path} for path in paths]):
+            counts.update(result['counts'])
+            metrics.merge(result['metrics'])
+
+    # the metrics are only reported here, for all the zip files
+    return summarize(args, counts, metrics, zips=len(paths))
+
+def import_zip(args, path: str, metrics: Metrics) -> dict:
+    """Imports the files from the saved payload at `path`. Returns the counts
+    from `import_files`"""
+
+    g = Gdoc.from_zip(path, metrics=metrics, languages=[x.upper() for x in args.language] if args.language else None)
+    g.set_param('dateFrom', args.date or '')
+    g.set_param('dateTo', args.date or '')
+    g.set_param('dutyStation', args.station)
+    g.set_param('symbol', query_symbol(args))
+    # the payload may have been saved for more symbols than requested
+    select = (lambda data: data['symbol1'] in args.symbol) if args.symbol else None
+
+    with file_index(args, metrics) as index, LogBuffer(DLX.handle['gdoc_log'], metrics=metrics) as log:
+        counts = import_files(g, args, log, select=select, index=index)
+
+    g.close()
+
+    return counts
+
+def _import_zip(kwargs: dict) -> dict:
+    # runs in a separate process. the counts and metrics are returned to the parent to be reported
+    metrics = Metrics()
+    args, g = init(kwargs, metrics)
+    g.close()
+
+    return {'counts': import_zip(args, args.from_zip, metrics), 'metrics': metrics.summary()}
+
+def query_symbol(args) -> str:
+    # the API takes one symbol per request. multiple symbols are requested in turn by `import_symbols`
+    return args.symbol[0] if args.symbol and len(args.symbol) == 1 else ''
+
+def init(kwargs: dict, metrics: Metrics) -> tuple:
+    """Parses and checks the run arguments, connects to DLX and S3, and returns
+    the args and a Gdoc with the query parameters set"""
+
+    with metrics.timer('init_args'):
+        args = get_args(**kwargs)
+
+    if args.date and args.date_from:
+        raise Exception('--date and --date_from are not compatible')
+
+    if not args.date and not args.date_from and not args.symbol and not args.from_zip:
+        raise Exception('--symbol, --date, --date_from or --from_zip required')
         
     if args.language and not args.symbol:
         raise Exception('--language requires --symbol')
 
-    DLX.connect(args.connection_string, database=args.database) 
-    S3.connect(bucket=args.s3_bucket) # not needed since AWS credentials are already in place
+    with metrics.timer('init_connect'):
+        connect(args)
     
-    g = Gdoc(
-        client_id=args.gdoc_client_id, 
-        client_secret=args.gdoc_client_secret,
-        token_url=args.gdoc_token_url,
-        api_url=args.gdoc_api_url,
-        ocp_apim_subscription_key=args.gdoc_ocp_apim_subscription_key,
-        scope=args.gdoc_scope
-    )
-    g.set_param('symbol', args.symbol or '')
+    with metrics.timer('init_gdoc'):
+        g = Gdoc(
+            client_id=args.gdoc_client_id, 
+            client_secret=args.gdoc_client_secret,
+            token_url=args.gdoc_token_url,
+            api_url=args.gdoc_api_url,
+            ocp_apim_subscription_key=args.gdoc_ocp_apim_subscription_key,
+            scope=args.gdoc_scope,
+            session=gdoc_session(),
+            cache=PayloadCache(args.cache_dir, max_bytes=args.cache_size * 1024 ** 2) if args.cache_dir else None,
+            metrics=metrics,
+            languages=[x.upper() for x in args.language] if args.language else None
+        )
+
+    g.set_param('symbol', query_symbol(args))
     g.set_param('dateFrom', args.date or '')
     g.set_param('dateTo', args.date or '')
     g.set_param('dutyStation', args.station or '')
 
-    if args.recursive:
-        if args.data_only or args.save_as:
-            raise Exception('--data_only and --save_as not compatible with --recursive')
-        
-        # call the run function for each indvidual symbol
-        seen = {}
-        
-        for data in g.data:
-            symbol = symbol=data['symbol1']
-            
-            if seen.get(symbol):
-                continue
-            
-            run(
-                connection_string=args.connection_string,
-                database=args.database,
-                s3_bucket=args.s3_bucket,
-                station=args.station,
-                date=args.date,
-                symbol=symbol,
-                overwrite=args.overwrite
+    return args, g
+
+def import_symbols(g: Gdoc, args, symbols: list, bibs: BibBatch = None, select: Callable = None, index: FileIndex = None) -> Counter:
+    """Downloads the payload for each symbol in turn and imports its files.
+    With --create_bibs, the bib records are created after all the files. The
+    files in `index` are not read. Returns the summed counts from `import_files`"""
+
+    g.set_param('DownloadFiles', 'Y')
+    counts = Counter()
+
+    if args.create_bibs and bibs is None:
+        bibs = BibBatch(metrics=g.metrics)
+
+    try:
+        with LogBuffer(DLX.handle['gdoc_log'], metrics=g.metrics) as log:
+            for _ in g.iter_symbols(symbols):
+                counts.update(import_files(g, args, log, bibs, select=select, index=index))
+    finally:
+        # the bibs for the symbols that were imported are created even if a later symbol fails
+        if bibs:
+            counts.update(bibs.commit())
+
+    return counts
+
+def changed_ids(data) -> set:
+    """Returns the jobIds and odsNos of the records that are new or have
+    changed since they were last imported"""
+
+    return set(filter(None, [x.get(field) for x in plan_incremental(data) for field in ('jobId', 'odsNo')]))
+
+def select_ids(ids: set) -> Callable:
+    """Returns a `select` function for `import_files` that matches the records
+    with a jobId or odsNo in `ids`"""
+
+    return lambda data: data.get('jobId') in ids or data.get('odsNo') in ids
+
+def summarize(args, counts: dict, metrics: Metrics, **extra) -> dict:
+    """Returns the summary of a run, which is also printed to STDOUT, with the
+    run's metrics. The metrics are printed in CloudWatch Embedded Metric Format,
+    and written to gdoc_log if --metrics_log is set"""
+
+    summary = {'station': args.station, 'date': args.date, 'files': 0, 'imported': 0, 'bibs_created': 0, **counts, **extra}
+    hits, misses = metrics.counters['file_index_hits'], metrics.counters['file_index_misses']
+
+    if hits + misses:
+        summary['file_index_hit_rate'] = round(hits / (hits + misses), 3)
+
+    print(json.dumps({'info': 'Run complete', 'data': summary}))
+    metrics.emit(dimensions={'station': args.station})
+
+    if args.metrics_log:
+        DLX.handle['gdoc_log'].insert_one(
+            {
+                'metrics': metrics.summary(),
+                'gdoc_station': args.station,
+                'gdoc_date': args.date,
+                'time': datetime.now(timezone.utc)
+            }
+        )
+
+    return {**summary, 'metrics': metrics.summary()}
+
+def import_files(g: Gdoc, args, log: LogBuffer, bibs: BibBatch = None, select: Callable = None, index: FileIndex = None):
+    """Imports the files in the current Gdoc payload into DLX. With
+    --create_bibs, the bibs needed for the imported English files are added to
+    `bibs`, to be created by the caller once all files are imported. If `bibs`
+    is not provided, they are created at the end of this payload. If `select`
+    is provided, only the files for which it returns True are imported. Files
+    that are in the file `index` are not read, and the imported files are
+    added to it. If `index` is not provided, all the files are read.
+    
+    Returns the number of files processed, files imported and bibs created, and
+    the number of records without a file and files without a record."""
+
+    # the date of the query, or the range of a multi-day window
+    date_from, date_to = g.parameters['dateFrom'], g.parameters['dateTo']
+    query_date = (date_from if date_from == date_to else f'{date_from}/{date_to}') or None
+
+    def wanted(data):
+        # this function is for use as the `select` function in Gdoc.iter_files, so that
+        # skipped files are not opened. languages are filtered by the Gdoc
+
+        if reason := excluded(data):
+            if reason == 'RES':
+                # printing to STDOUT allows caputre in Cloudwatch. Cloudwatch queries can parse JSON strings for searching the logs
+                print(json.dumps({'info': 'Skipping document with distribution type "RES"', 'symbol': data['symbol1']}))
+
+            g.metrics.incr('files_skipped')
+
+            return False
+
+        return select is None or select(data)
+
+    def precheck(info, data):
+        # this function is for use as the `precheck` function in Gdoc.iter_files. files that are
+        # in the index are not read. if the document has new symbols, they are added to the DLX file
+        nonlocal known
+
+        if index is None or not (entry := index.get(key := FileIndex.key(data, info))):
+            return True
+
+        symbols = [x for x in (data['symbol1'], data['symbol2']) if x and not x.isspace()]
+        new = [x for x in symbols if x not in entry['symbols']]
+
+        if new:
+            result = DLX.handle['files'].update_one(
+                {'_id': entry['file_id']},
+                {'$addToSet': {'identifiers': {'$each': [{'type': 'symbol', 'value': x} for x in new]}}}
             )
 
-            seen[symbol] = True;
-        
-        return
-    elif args.data_only:
-        g.set_param('DownloadFiles', 'N')
-        print(json.dumps(g.data))
-        exit()
-    elif args.save_as:
-        print(f'Saving payload to file path: {args.save_as}')
-        g.download(save_as=args.save_as)
-        print('Done')
-        exit()
-    else:
-        g.set_param('DownloadFiles', 'Y')
-      
+            if result.matched_count == 0:
+                # the file is no longer in DLX
+                index.discard(key)
+
+                return True
+
+            index.add(key, entry['file_id'], new)
+            message = {'info': 'Relinked', 'data': {'symbols': new}}
+            print(json.dumps({'info': 'Relinked', 'data': {'checksum': entry['file_id'], 'symbols': new}}))
+            g.metrics.incr('files_relinked')
+        else:
+            message = {'info': 'Unchanged'}
+            g.metrics.incr('files_unchanged')
+
+        # logged with the fingerprint, so that incremental runs know that revised metadata has been seen
+        log.insert(
+            {
+                'imported': False,
+                'message': message,
+                'gdoc_station': args.station,
+                'gdoc_date': query_date,
+                'symbols': symbols,
+                'languages': [LANGUAGES[data['languageId']]],
+                'file_id': entry['file_id'],
+                'time': datetime.now(timezone.utc),
+                'gdoc_job_id': data.get('jobId'),
+                'gdoc_ods_no': data.get('odsNo'),
+                'gdoc_fingerprint': fingerprint(data),
+                'gdoc_crc': info.CRC,
+                'gdoc_size': info.file_size,
+                'gdoc_checksum': entry['file_id']
+            }
+        )
+        known += 1
+
+        return False
+
     def upload(fh, data):
         # this function is for use as the callback in Gdoc.iter_files
-
-        if data['distributionType'] == 'RES':
-            # printing to STDOUT allows caputre in Cloudwatch. Cloudwatch queries can parse JSON strings for searching the logs
-            print(json.dumps({'info': 'Skipping document with distribution type "RES"', 'symbol': data['symbol1']}))
-            
-            return
-        
         symbols = [data['symbol1']]
         
         if data['symbol2'] and not data['symbol2'].isspace():
             symbols.append(data['symbol2'])
-    
-        if any([re.search(r'JOURNAL', x) for x in symbols]):
-            return
-        
-        lang = {'A': 'AR', 'C': 'ZH', 'E': 'EN', 'F': 'FR', 'R': 'RU', 'S': 'ES', 'G': 'DE'}[data['languageId']]
-        
-        if args.language and args.language.upper() != data['languageId']:
-            return
         
+        lang = LANGUAGES[data['languageId']]
         identifiers = [Identifier('symbol', x) for x in filter(None, symbols)]
         languages = [lang]
         overwrite = True if args.overwrite else False
-        import_result = None
+        import_result = file_id = None
 
         try:
-            import_result = File.import_from_handle(
-                fh,
-                filename=File.encode_fn(list(filter(None, symbols)), lang, 'pdf'),
-                identifiers=identifiers,
-                languages=languages,
-                mimetype='application/pdf',
-                source='gdoc-dlx-' + args.station,
-                overwrite=overwrite
-            )
+            with g.metrics.timer('import'):
+                import_result = File.import_from_handle(
+                    fh,
+                    filename=File.encode_fn(list(filter(None, symbols)), lang, 'pdf'),
+                    identifiers=identifiers,
+                    languages=languages,
+                    mimetype='application/pdf',
+                    source='gdoc-dlx-' + args.station,
+                    overwrite=overwrite
+                )
+            
+            g.metrics.incr('files_imported')
+            file_id = import_result.id
         except FileExistsConflict as e:
             to_log = {'warning': e.message, 'data': {'symbols': symbols, 'language': languages}}
             print(json.dumps(to_log))
+            g.metrics.incr('files_conflict')
         except FileExists:
             to_log = {'info': 'Already in the system', 'data': {'symbols': symbols, 'language': languages}}
             print(json.dumps(to_log))
+            g.metrics.incr('files_exist')
+            # files are stored by checksum
+            file_id = fh.md5
         except Exception as e:
             to_log = {'error': '; '.join(re.split('[\r\n]', str(e))), 'data': {'symbols': symbols, 'languages': languages}}
             print(json.dumps(to_log))
+            g.metrics.incr('files_error')
+
+        if index is not None and file_id:
+            index.add(FileIndex.key(data, fh.info), file_id, symbols)
 
         if import_result:
             # log in DB
-            DLX.handle['gdoc_log'].insert_one(
+            log.insert(
                 {
                     'imported': True,
                     'gdoc_station': args.station,
-                    'gdoc_date': args.date,
+                    'gdoc_date': query_date,
                     'symbols': symbols,
                     'languages': languages,
                     'file_id': import_result.id,
-                    'time': datetime.now(timezone.utc)
+                    'time': datetime.now(timezone.utc),
+                    'gdoc_job_id': data.get('jobId'),
+                    'gdoc_ods_no': data.get('odsNo'),
+                    'gdoc_fingerprint': fingerprint(data),
+                    'gdoc_crc': fh.info.CRC,
+                    'gdoc_size': fh.info.file_size,
+                    'gdoc_checksum': fh.md5
                 }
             )
 
             return import_result
         else:
             # log in DB
-            DLX.handle['gdoc_log'].insert_one(
+            log.insert(
                 {
                     'imported': False,
                     'message': to_log,
                     'gdoc_station': args.station,
-                    'gdoc_date': args.date,
+                    'gdoc_date': query_date,
                     'symbols': symbols,
                     'languages': languages,
                     'file_id': None,
-                    'time': datetime.now(timezone.utc)
+                    'time': datetime.now(timezone.utc),
+                    'gdoc_job_id': data.get('jobId'),
+                    'gdoc_ods_no': data.get('odsNo'),
+                    'gdoc_fingerprint': fingerprint(data),
+                    'gdoc_crc': fh.info.CRC,
+                    'gdoc_size': fh.info.file_size,
+                    'gdoc_checksum': fh.md5
                 }
             )
     
@@ -249,44 +945,49 @@ def run(**kwargs): # *, station, date, symbol=None, language=None, overwrite=Non
             symbols_index[symbol].append(data)
     except Exception as e:
         print(json.dumps({'error': '; '.join(re.split('[\r\n]', str(e)))}))
+
+    known = 0
+
+    if args.create_bibs:
+        # bibs are only committed here if the caller does not
+        commit_bibs = bibs is None
+        bibs = bibs or BibBatch(metrics=g.metrics)
+        bibs.lookup(gdoc_symbols(g.data))
     
-    i = 0
-    
+    # plan the payload's import from the manifest and the zip central directory before anything is uploaded
+    planned = g.reconcile_totals()
+    print(json.dumps({'info': 'Import plan', 'data': {'symbols': g.parameters['symbol'], **planned, 'indexed': len(index.entries) if index else 0}}))
+
+    i = imported = 0
+    bib_counts = {}
+
     try:
-        # Gdoc.iter_files() takes a callback function as its only argument
-        for result in g.iter_files(upload):
+        # Gdoc.iter_files() takes a callback function that is run for each file
+        for result in g.iter_files(upload, workers=args.workers, select=wanted, single_pass=True, precheck=precheck):
             i += 1
+
+            if i % PROGRESS_INTERVAL == 0:
+                print(json.dumps({'info': 'Progress', 'data': {'files': i, 'matched': planned['matched'], 'symbols': g.parameters['symbol']}}))
             
             if isinstance(result, File):
+                imported += 1
                 symbols = [x.value for x in result.identifiers]
                 print(json.dumps({'info': 'OK', 'data': {'checksum': result.id, 'symbols': symbols, 'languages': result.languages}}))
             
-                # create bib record if option enabled
-                if not args.create_bibs or result.languages[0].lower() != 'en':
-                    pass
-                elif bib := Bib.from_query(Query(Or(Condition('191', {'a': {'$in': symbols}}), Condition('191', {'z': {'$in': symbols}})))):
-                    print('Bib record for {symbols} already exists')
-                else:
-                    new_bib = Bib()
-
-                    for symbol in symbols:
-                        new_bib.set('191', 'a', symbol, address='+')
-
-                    new_bib.set('245', 'a', 'Work in progress')
-
-                    titles = [x.get('title') for x in symbols_index[symbols[0]]]
-                    
-                    for title in titles:
-                        if title not in new_bib.get_values('246', 'a'):
-                            new_bib.set('246', 'a', title, address='+')
-
-                    new_bib.commit(user='gDoc import')
-                    print(json.dumps({'info': 'Created new bib', 'data': {'record_id': new_bib.id}}))
+                # queue the bib record to create if option enabled
+                if args.create_bibs and result.languages[0].lower() == 'en':
+                    bibs.add(symbols, [x.get('title') for x in symbols_index.get(symbols[0], [])])
     except Exception as e:
         print(json.dumps({'error': '; '.join(re.split('[\r\n]', str(e)))}))
-        
-    if i == 0:
-        print(json.dumps({'info': 'No results', 'data': {'station': args.station, 'date': args.date, 'symbols': args.symbol, 'language': args.language}}))
+    finally:
+        # the bibs for the files that were imported are created even if the import was interrupted
+        if args.create_bibs and commit_bibs:
+            bib_counts = bibs.commit()
+
+    if i == 0 and not known:
+        print(json.dumps({'info': 'No results', 'data': {'station': args.station, 'date': query_date, 'symbols': g.parameters['symbol'], 'language': args.language}}))
+
+    return {'files': i, 'imported': imported, 'bibs_created': 0, 'missing_files': planned['missing_files'], 'orphan_files': planned['orphan_files'], **bib_counts}
 
 ###
 
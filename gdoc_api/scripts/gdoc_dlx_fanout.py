@@ -0,0 +1,197 @@
+"""
+Runs gdoc-dlx for a station-day as independent work items, so that a heavy
+day can be spread across several Lambda invocations and a timeout only loses
+one batch.
+
+The planner gets the metadata for the station-day without the files, groups
+the documents by symbol, and splits the symbols into batches of about the same
+number of documents. Each batch is a JSON work item that can be sent to a
+queue. The worker takes one work item and imports its symbols. `LocalQueue`
+runs the same pipeline in process.
+
+Usage:
+    from gdoc_api.scripts import gdoc_dlx_fanout
+
+    items = gdoc_dlx_fanout.plan(station='NY', date='2021-01-03', batch_size=500)
+    gdoc_dlx_fanout.work(items[0])
+
+    gdoc_dlx_fanout.run(station='NY', date='2021-01-03')
+
+    gdoc-dlx-fanout --station NY --date 2021-01-03 --plan_only > items.ndjson
+    gdoc-dlx-fanout --work items.ndjson
+"""
+
+import sys, json, heapq, math, re
+from argparse import ArgumentParser
+from collections import Counter, deque
+from gdoc_api.metrics import Metrics
+from gdoc_api.scripts import gdoc_dlx
+
+BATCH_SIZE = 500 # documents per work item
+
+def plan(*, batch_size: int = BATCH_SIZE, **kwargs) -> list:
+    """Returns the work items for a gdoc-dlx run. `kwargs` are the arguments of
+    gdoc_dlx.run. With `incremental`, only the new and changed documents are
+    planned, and each work item lists their ids"""
+
+    metrics = Metrics()
+    args, g = gdoc_dlx.init(kwargs, metrics)
+    g.set_param('DownloadFiles', 'N')
+    select = gdoc_dlx.select_ids(gdoc_dlx.changed_ids(g.data)) if args.incremental else None
+    counts, ids = Counter(), {}
+
+    for data in g.data:
+        if args.symbol and data['symbol1'] not in args.symbol:
+            continue
+
+        if select is None or select(data):
+            counts[data['symbol1']] += 1
+            ids.setdefault(data['symbol1'], []).extend(filter(None, [data.get('jobId'), data.get('odsNo')]))
+
+    g.close()
+    batches = balance(counts, batch_size)
+    # the work items are JSON, so dates are sent as strings
+    options = {k: v for k, v in json.loads(json.dumps(kwargs, default=str)).items() if k not in ('recursive', 'incremental')}
+    items = []
+
+    for i, symbols in enumerate(batches):
+        items.append(
+            {
+                'run': options,
+                'symbols': symbols,
+                'documents': sum(counts[x] for x in symbols),
+                'ids': [x for symbol in symbols for x in ids[symbol]] if args.incremental else None,
+                'batch': i,
+                'batches': len(batches)
+            }
+        )
+
+    return items
+
+def balance(counts: dict, batch_size: int) -> list:
+    """Splits the keys of `counts` into lists whose summed counts are about
+    equal and, where possible, no more than `batch_size`. Keys are assigned in
+    descending order of their count to the batch with the smallest total"""
+
+    if not counts:
+        return []
+
+    batches = [(0, i, []) for i in range(math.ceil(sum(counts.values()) / batch_size))]
+
+    for key in sorted(counts, key=lambda x: counts[x], reverse=True):
+        total, i, keys = heapq.heappop(batches)
+        keys.append(key)
+        heapq.heappush(batches, (total + counts[key], i, keys))
+
+    return [keys for _, _, keys in sorted(batches, key=lambda x: x[1]) if keys]
+
+def work(item: dict) -> dict:
+    """Imports the symbols in a work item. Returns the run summary"""
+
+    metrics = Metrics()
+    args, g = gdoc_dlx.init(item['run'], metrics)
+    select = gdoc_dlx.select_ids(set(item['ids'])) if item.get('ids') is not None else None
+    # bibs are looked up from each symbol's payload
+    with gdoc_dlx.file_index(args, metrics) as index:
+        counts = gdoc_dlx.import_symbols(g, args, item['symbols'], select=select, index=index)
+    g.close()
+
+    return gdoc_dlx.summarize(args, counts, metrics, symbols=len(item['symbols']), batch=item['batch'])
+
+class LocalQueue():
+    """In-process stand-in for a message queue such as SQS. Messages are stored
+    as JSON strings, so anything that passes through it can also be sent to a
+    real queue.
+
+    Usage:
+        queue = LocalQueue()
+        queue.send({...})
+        item = queue.receive()
+    """
+
+    def __init__(self):
+        self.messages = deque()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def send(self, item: dict) -> None:
+        self.messages.append(json.dumps(item))
+
+    def receive(self) -> dict:
+        """Returns the next message, or None if the queue is empty"""
+
+        return json.loads(self.messages.popleft()) if self.messages else None
+
+def run(*, queue: LocalQueue = None, batch_size: int = BATCH_SIZE, **kwargs) -> dict:
+    """Plans a gdoc-dlx run, sends the work items to `queue` and processes them
+    until the queue is empty. Work items that fail are reported and do not stop
+    the others. Returns the summed counts"""
+
+    queue = queue or LocalQueue()
+    items = plan(batch_size=batch_size, **kwargs)
+
+    for item in items:
+        queue.send(item)
+
+    print(json.dumps({'info': f'Planned {len(items)} work items', 'data': {'documents': sum(x['documents'] for x in items)}}))
+
+    counts, failed, batches = Counter(), [], 0
+
+    while (item := queue.receive()) is not None:
+        batches += 1
+
+        try:
+            summary = work(item)
+            counts.update({k: summary[k] for k in ('files', 'imported', 'bibs_created')})
+        except Exception as e:
+            print(json.dumps({'error': '; '.join(re.split('[\r\n]', str(e))), 'data': {'batch': item['batch'], 'symbols': item['symbols']}}))
+            failed.append(item)
+
+    result = {'batches': batches, 'failed': len(failed), **counts}
+    print(json.dumps({'info': 'Fan-out complete', 'data': result}))
+
+    return {**result, 'failed_items': failed}
+
+def get_args():
+    parser = ArgumentParser(prog='gdoc-dlx-fanout')
+    parser.add_argument('--station', choices=['NY', 'GE', 'Vienna', 'Beirut', 'Bangkok', 'Nairobi'])
+    parser.add_argument('--date', help='YYYY-MM-DD')
+    parser.add_argument('--batch_size', type=int, default=BATCH_SIZE, help='number of documents per work item')
+    parser.add_argument('--create_bibs', action='store_true')
+    parser.add_argument('--overwrite', action='store_true')
+    parser.add_argument('--incremental', action='store_true')
+    parser.add_argument('--workers', type=int, default=1, help='number of files to upload at a time in each work item')
+    parser.add_argument('--plan_only', action='store_true', help='print the work items to STDOUT, one JSON object per line, without importing')
+    parser.add_argument('--work', help='run the work items in this file, one JSON object per line. "-" reads from STDIN')
+
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+
+    if args.work:
+        fh = sys.stdin if args.work == '-' else open(args.work)
+
+        with fh:
+            for line in filter(str.strip, fh):
+                work(json.loads(line))
+
+        return
+
+    if not (args.station and args.date):
+        raise Exception('--station and --date are required unless --work is used')
+
+    kwargs = {'station': args.station, 'date': args.date, 'workers': args.workers}
+    kwargs.update({k: True for k in ('create_bibs', 'overwrite', 'incremental') if getattr(args, k)})
+
+    if args.plan_only:
+        for item in plan(batch_size=args.batch_size, **kwargs):
+            print(json.dumps(item))
+    else:
+        run(batch_size=args.batch_size, **kwargs)
+
+###
+
+if __name__ == '__main__':
+    main()
@@ -1,37 +1,150 @@
 """
 Runs gdoc-dlx for one day. Completed days are recorded in the database. The
-script runs for the next day after that last completed one. Logs are printed to
-STDOUT for capture in CloudWatch
+script runs for the next day after that last completed one, skipping the days
+that a backfill has completed. Logs are printed to STDOUT for capture in
+CloudWatch
+
+With a date range, runs gdoc-dlx for each station and day in the range, several
+at a time. Each station-day is recorded in the database when it completes or
+fails, so that running the same range again only runs the units that have not
+completed.
 
 Usage:
     from gdoc_api.scripts import gdoc_dlx_retro
-    
+
     gdoc_dlx_retro.run()
+    gdoc_dlx_retro.run(date_from='2017-07-24', date_to='2017-12-31', workers=4)
+
+    gdoc-dlx-retro --date_from 2017-07-24 --date_to 2017-12-31 --workers 4
 """
 
-import boto3
-from datetime import datetime, timedelta
+import boto3, json, re, time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from pymongo import DESCENDING
 from dlx import DB
 from gdoc_api.scripts import gdoc_dlx
 
-def run():
+STATIONS = ('NY', 'GE')
+
+def run(date_from: str = None, date_to: str = None, *, workers: int = 4, stations: tuple = STATIONS):
     ssm = boto3.client('ssm')
     DB.connect(ssm.get_parameter(Name='prodISSU-admin-connect-string')['Parameter']['Value'], database='undlFiles')
+
+    if date_from:
+        return backfill(date_from, date_to or date_from, workers=workers, stations=stations)
+
+    return run_next(stations=stations)
+
+def run_next(*, stations: tuple = STATIONS) -> list:
+    """Runs gdoc-dlx for each station on the day after the last completed one.
+    Days that a backfill has completed for all the stations are skipped, and
+    stations that a backfill has completed are not run again. The day is only
+    recorded as completed if all its stations complete. Returns the completion
+    record of each station that was run"""
+
     col = DB.handle['gdoc_dlx_retro']
     last_record = col.find_one({}, sort=[('issue_date', DESCENDING)])
-        
+
     if not last_record:
         next_date = datetime.strptime('2017-07-24', '%Y-%m-%d') # first known gdoc day
-    else:    
+    else:
         next_date = last_record['issue_date'] + timedelta(days=1)
-    
-    for station in ('NY', 'GE'):
-        gdoc_dlx.run(station=station, date=next_date.strftime('%Y-%m-%d'), recursive=True)
-        
-    col.insert_one({'issue_date': next_date, 'completed': datetime.now()})
+
+    while not (pending := [x for x in stations if (x, next_date) not in completed_units(next_date, next_date)]):
+        col.insert_one({'issue_date': next_date, 'completed': datetime.now()})
+        next_date += timedelta(days=1)
+
+    results = [run_unit(station, next_date) for station in pending]
+
+    if all(x['status'] == 'completed' for x in results):
+        col.insert_one({'issue_date': next_date, 'completed': datetime.now()})
+
+    return results
+
+def completed_units(start: datetime, end: datetime) -> set:
+    """Returns the (station, day) of the station-days from `start` to `end`
+    that have completed"""
+
+    return {
+        (x['station'], x['issue_date']) for x in
+        DB.handle['gdoc_dlx_retro_units'].find({'issue_date': {'$gte': start, '$lte': end}, 'status': 'completed'}, projection={'station': 1, 'issue_date': 1})
+    }
+
+def backfill(date_from: str, date_to: str, *, workers: int = 4, stations: tuple = STATIONS) -> list:
+    """Runs gdoc-dlx for each station and day from `date_from` to `date_to`
+    (YYYY-MM-DD), with up to `workers` station-days running at a time. Station-
+    days already completed by a previous backfill or daily run are skipped.
+    Returns the completion record of each station-day that was run."""
+
+    start, end = (datetime.strptime(x, '%Y-%m-%d') for x in (date_from, date_to))
+
+    if end < start:
+        raise Exception('date_to must not be before date_from')
+
+    days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+    completed = completed_units(start, end)
+    units = [(station, day) for day in days for station in stations if (station, day) not in completed]
+    print(json.dumps({'info': f'Backfilling {len(units)} station-days', 'data': {'date_from': date_from, 'date_to': date_to, 'already_completed': len(completed)}}))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda unit: run_unit(*unit), units))
+
+    failed = [x for x in results if x['status'] == 'failed']
+    print(json.dumps({'info': 'Backfill complete', 'data': {'completed': len(results) - len(failed), 'failed': len(failed)}}))
+
+    return results
+
+def run_unit(station: str, day: datetime) -> dict:
+    """Runs gdoc-dlx for one station and day and records the result. The
+    station-day fails if gdoc-dlx raises an exception, or if it tried to
+    import files and all of them failed"""
+
+    started, timer = datetime.now(timezone.utc), time.perf_counter()
+
+    try:
+        counts = gdoc_dlx.run(station=station, date=day.strftime('%Y-%m-%d'), recursive=True)
+        errors = counts['metrics']['counters'].get('files_error', 0)
+
+        # gdoc-dlx logs the files that fail to import and carries on
+        if errors and errors >= counts['files']:
+            status, error = 'failed', f'All {errors} files failed to import'
+            print(json.dumps({'error': error, 'data': {'station': station, 'date': day.strftime('%Y-%m-%d')}}))
+        else:
+            status, error = 'completed', None
+    except Exception as e:
+        counts, status, error = None, 'failed', '; '.join(re.split('[\r\n]', str(e)))
+        print(json.dumps({'error': error, 'data': {'station': station, 'date': day.strftime('%Y-%m-%d')}}))
+
+    record = {
+        'station': station,
+        'issue_date': day,
+        'status': status,
+        'counts': counts,
+        'error': error,
+        'started': started,
+        'completed': datetime.now(timezone.utc),
+        'seconds': round(time.perf_counter() - timer, 3)
+    }
+    DB.handle['gdoc_dlx_retro_units'].replace_one({'station': station, 'issue_date': day}, record, upsert=True)
+
+    return record
+
+def get_args():
+    parser = ArgumentParser(prog='gdoc-dlx-retro')
+    parser.add_argument('--date_from', help='YYYY-MM-DD. backfill from this day instead of running the next day after the last completed one')
+    parser.add_argument('--date_to', help='YYYY-MM-DD. last day of the backfill. defaults to --date_from')
+    parser.add_argument('--workers', type=int, default=4, help='number of station-days to run at a time in a backfill')
+    parser.add_argument('--station', action='append', choices=['NY', 'GE', 'Vienna', 'Beirut', 'Bangkok', 'Nairobi'], help='station to run. can be repeated. defaults to NY and GE')
+
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    run(args.date_from, args.date_to, workers=args.workers, stations=tuple(args.station or STATIONS))
 
 ###
 
 if __name__ == '__main__':
-    run()
+    main()
@@ -0,0 +1,212 @@
+"""
+Index of the gDoc files that are already in DLX, keyed by the jobId or odsNo
+of the document and the CRC and size of its PDF in the zip file. gdoc-dlx
+loads the index once per run and skips the zip members that it knows, without
+reading them. If the document has symbols that the DLX file does not have yet,
+they are added to the file as identifiers instead.
+
+The index is kept in the gdoc_file_index collection. gdoc-dlx adds the files
+it imports, and the index can be rebuilt from gdoc_log.
+
+Usage:
+    gdoc-file-index --rebuild
+    gdoc-file-index --stats
+"""
+
+import re, json, time
+from argparse import ArgumentParser
+from threading import Lock
+from pymongo import InsertOne, DeleteMany
+from dlx import DB as DLX
+from gdoc_api.metrics import Metrics
+
+COLLECTION = 'gdoc_file_index'
+
+class FileIndex():
+    """In-memory copy of the index for one run. Lookups are dict lookups, and
+    hits and misses are counted in the run's metrics. Changes are buffered and
+    written to the database in bulk, in the same way as gdoc-dlx's LogBuffer:
+    when `size` entries have changed, when `interval` seconds have passed since
+    the last write, and when the context exits.
+
+    Usage:
+        with FileIndex.load(metrics=g.metrics) as index:
+            entry = index.get(FileIndex.key(data, info))
+    """
+
+    def __init__(self, entries: dict = None, *, size: int = 500, interval: float = 10, metrics: Metrics = None):
+        self.entries = entries or {} # key -> {'file_id': str, 'symbols': set}
+        self.metrics = metrics or Metrics()
+        self.size = size
+        self.interval = interval
+        self.pending = {} # _id -> the entry's document to write, or None to delete it
+        self.lock = Lock()
+        self.flushed = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    @classmethod
+    def load(cls, **kwargs) -> 'FileIndex':
+        """Returns the index from the database"""
+
+        index = cls(**kwargs)
+
+        with index.metrics.timer('file_index_load'):
+            for doc in DLX.handle[COLLECTION].find({}, projection={'gdoc_id': 1, 'crc': 1, 'size': 1, 'file_id': 1, 'symbols': 1}):
+                index.entries[(doc['gdoc_id'], doc['crc'], doc['size'])] = {'file_id': doc['file_id'], 'symbols': set(doc['symbols'])}
+
+        return index
+
+    @staticmethod
+    def key(data: dict, info) -> tuple:
+        """Returns the index key for a metadata record and the ZipInfo of its file"""
+
+        return (data.get('jobId') or data.get('odsNo'), info.CRC, info.file_size)
+
+    def get(self, key: tuple) -> dict:
+        """Returns the entry for `key`, or None"""
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+        self.metrics.incr('file_index_hits' if entry else 'file_index_misses')
+
+        return entry
+
+    def add(self, key: tuple, file_id: str, symbols: list) -> None:
+        """Adds or updates the entry for `key`, in memory and in the database"""
+
+        with self.lock:
+            entry = self.entries.setdefault(key, {'file_id': file_id, 'symbols': set()})
+            entry['file_id'] = file_id
+            entry['symbols'].update(symbols)
+            self._write(key, {'_id': _id(key), 'gdoc_id': key[0], 'crc': key[1], 'size': key[2], 'file_id': file_id, 'symbols': sorted(entry['symbols'])})
+
+    def discard(self, key: tuple) -> None:
+        """Removes the entry for `key`, for files that are no longer in DLX"""
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self._write(key, None)
+
+    def flush(self) -> None:
+        """Writes the buffered changes to the database"""
+
+        with self.lock:
+            self._flush()
+
+    def _write(self, key, doc):
+        # the entry's latest state replaces its buffered write, as it contains all of the entry's symbols
+        self.pending[_id(key)] = doc
+
+        if len(self.pending) >= self.size or time.monotonic() - self.flushed >= self.interval:
+            self._flush()
+
+    def _flush(self):
+        pending, self.pending = self.pending, {}
+        self.flushed = time.monotonic()
+
+        if pending:
+            # the documents are written whole, so the changed entries are deleted and the current ones inserted in one request
+            ops = [DeleteMany({'_id': {'$in': list(pending)}})] + [InsertOne(doc) for doc in pending.values() if doc]
+
+            try:
+                with self.metrics.timer('file_index_write'):
+                    DLX.handle[COLLECTION].bulk_write(ops)
+            except Exception as e:
+                # the index is only an optimization. entries that are not written are added again on the next import
+                print(json.dumps({'error': 'gdoc_file_index write failed: ' + '; '.join(re.split('[\r\n]', str(e)))}))
+
+    def stats(self) -> dict:
+        """Returns the number of entries and the hits and misses of this run"""
+
+        hits, misses = self.metrics.counters['file_index_hits'], self.metrics.counters['file_index_misses']
+
+        return {'entries': len(self.entries), 'hits': hits, 'misses': misses, 'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None}
+
+def _id(key: tuple) -> str:
+    return ':'.join(map(str, key))
+
+def rebuild(*, batch_size: int = 1000) -> int:
+    """Rebuilds the index from the gdoc_log entries of files that were imported,
+    already in the system, relinked or unchanged, keeping the files that are still in DLX.
+    Returns the number of entries"""
+
+    entries = {}
+    query = {'gdoc_crc': {'$exists': True}, 'gdoc_checksum': {'$ne': None}, '$or': [{'imported': True}, {'message.info': {'$in': ['Already in the system', 'Relinked', 'Unchanged']}}]}
+    projection = {'gdoc_job_id': 1, 'gdoc_ods_no': 1, 'gdoc_crc': 1, 'gdoc_size': 1, 'gdoc_checksum': 1}
+
+    # later entries replace earlier ones
+    for entry in DLX.handle['gdoc_log'].find(query, projection=projection).sort('time', 1):
+        key = (entry.get('gdoc_job_id') or entry.get('gdoc_ods_no'), entry['gdoc_crc'], entry['gdoc_size'])
+        entries[key] = entry['gdoc_checksum']
+
+    # the symbols are taken from the files, as they may have been changed since they were imported
+    checksums, files = list(set(entries.values())), {}
+
+    for i in range(0, len(checksums), batch_size):
+        for f in DLX.handle['files'].find({'_id': {'$in': checksums[i:i + batch_size]}}, projection={'identifiers': 1}):
+            files[f['_id']] = sorted(x['value'] for x in f['identifiers'] if x['type'] == 'symbol')
+
+    docs = [
+        {'_id': _id(key), 'gdoc_id': key[0], 'crc': key[1], 'size': key[2], 'file_id': file_id, 'symbols': files[file_id]}
+        for key, file_id in entries.items() if key[0] and file_id in files
+    ]
+
+    col = DLX.handle[COLLECTION]
+    col.delete_many({})
+
+    for i in range(0, len(docs), batch_size):
+        col.insert_many(docs[i:i + batch_size], ordered=False)
+
+    print(json.dumps({'info': 'File index rebuilt', 'data': {'entries': len(docs), 'log_entries': len(entries)}}))
+
+    return len(docs)
+
+def stats() -> dict:
+    """Returns the number of entries in the index, and the hit rate of the runs
+    whose metrics were written to gdoc_log with --metrics_log"""
+
+    hits = misses = 0
+
+    for doc in DLX.handle['gdoc_log'].find({'metrics.counters.file_index_hits': {'$exists': True}}, projection={'metrics.counters': 1}):
+        hits += doc['metrics']['counters'].get('file_index_hits', 0)
+        misses += doc['metrics']['counters'].get('file_index_misses', 0)
+
+    return {
+        'entries': DLX.handle[COLLECTION].estimated_document_count(),
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None
+    }
+
+def get_args():
+    parser = ArgumentParser(prog='gdoc-file-index')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild the index from gdoc_log')
+    parser.add_argument('--stats', action='store_true', help='print the size of the index and its hit rate in the runs logged with --metrics_log')
+    parser.add_argument('--connection_string', help='supplied by AWS SSM if not provided')
+    parser.add_argument('--database')
+
+    return parser.parse_args()
+
+def main():
+    from gdoc_api.scripts import gdoc_dlx
+
+    args = get_args()
+    connection_string, database = gdoc_dlx.dlx_connection(args.connection_string, args.database)
+    DLX.connect(connection_string, database=database)
+
+    if args.rebuild:
+        rebuild()
+
+    if args.stats or not args.rebuild:
+        print(json.dumps(stats()))
+
+###
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""
+Local stand-in for the gDoc API, serving synthetic payloads. Used by the tests
+and by benchmarks/gdoc_dlx_bench.py.
+
+Usage:
+    from gdoc_api.tests.gdoc_server import GdocServer, make_metadata
+
+    with GdocServer(make_metadata(100)) as server:
+        g = Gdoc(..., api_url=server.api_url, token_url=server.token_url)
+"""
+
+import io, json, random, string, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from zipfile import ZipFile, ZIP_DEFLATED
+
+LANGUAGES = ('E', 'F', 'S', 'R', 'A', 'C', 'G')
+
+def make_metadata(documents: int, languages: int = 6, *, naming: str = 'jobId', seed: int = 0) -> list:
+    """Returns `documents` export.txt records, with each symbol issued in
+    `languages` languages. Files are named by `naming` ('jobId' or 'odsNo')"""
+
+    rng = random.Random(seed)
+    records = []
+
+    for i in range(documents):
+        symbol = f'A/{70 + i // languages // 1000}/L.{i // languages}'
+        lang = LANGUAGES[i % languages]
+        job_id = f'N{2100000 + i}'
+        records.append(
+            {
+                'jobId': job_id if naming == 'jobId' else '',
+                'odsNo': f'{job_id}{lang}',
+                'symbol1': symbol,
+                'symbol2': f'{symbol}/Add.1' if i % 11 == 0 else ' ',
+                'languageId': lang,
+                'distributionType': 'RES' if i % 50 == 0 else 'GEN',
+                'title': ' '.join(''.join(rng.choices(string.ascii_lowercase, k=8)) for _ in range(6)),
+                'publicationDate': '1970-01-01',
+                'dutyStation': 'NY'
+            }
+        )
+
+    return records
+
+def make_payload(records: list, *, files: bool = True, pdf_size: int = 100_000) -> bytes:
+    """Returns a zip file in the format returned by the gDoc API"""
+
+    buffer = io.BytesIO()
+
+    with ZipFile(buffer, 'w', compression=ZIP_DEFLATED) as z:
+        z.writestr('export.txt', json.dumps(records))
+
+        if files:
+            for record in records:
+                name = record['jobId'] or record['odsNo']
+                # PDFs are mostly already compressed, so the content is random. it is seeded by
+                # the file name so that the same document has the same content in every payload
+                z.writestr(f'{name}.pdf', b'%PDF-1.4\n' + random.Random(name).randbytes(pdf_size))
+
+    return buffer.getvalue()
+
+class GdocServer():
+    """Local stand-in for the gDoc API and its token endpoint. Payloads are
+    built from `records` for each combination of symbol and DownloadFiles.
+    Range requests are supported. `interrupt` is the number of responses to cut
+    off halfway through, to exercise resumed downloads.
+
+    Usage:
+        with GdocServer(records) as server:
+            g = Gdoc(..., api_url=server.api_url, token_url=server.token_url)
+    """
+
+    def __init__(self, records: list, *, pdf_size: int = 100_000, interrupt: int = 0):
+        self.records = records
+        self.pdf_size = pdf_size
+        self.interrupt = interrupt
+        self.payloads = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.url = f'http://127.0.0.1:{self.httpd.server_port}'
+        self.api_url = self.url + '/GetODSDocuments'
+        self.token_url = self.url + '/token'
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def payload(self, symbol: str, files: bool) -> bytes:
+        with self.lock:
+            if (symbol, files) not in self.payloads:
+                records = [x for x in self.records if not symbol or x['symbol1'] == symbol]
+                self.payloads[(symbol, files)] = make_payload(records, files=files, pdf_size=self.pdf_size)
+
+            return self.payloads[(symbol, files)]
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                body = json.dumps({'access_token': 'benchmark', 'token_type': 'Bearer', 'expires_in': 3600}).encode()
+                self._send(200, body, {'Content-Type': 'application/json'})
+
+            def do_GET(self):
+                query = {k: v[0] for k, v in parse_qs(urlparse(self.path).query, keep_blank_values=True).items()}
+                server.requests.append(query)
+                body = server.payload(query.get('symbol', ''), query.get('DownloadFiles') == 'Y')
+                status, start = 200, 0
+
+                if r := self.headers.get('Range'):
+                    status, start = 206, int(r.split('=')[1].split('-')[0])
+
+                with server.lock:
+                    cut = server.interrupt > 0 and start == 0
+
+                    if cut:
+                        server.interrupt -= 1
+
+                headers = {'Content-Type': 'application/zip', 'Accept-Ranges': 'bytes'}
+                self._send(status, body[start:], headers, cut=cut)
+
+            def _send(self, status, body, headers, cut=False):
+                self.send_response(status)
+
+                for name, value in {**headers, 'Content-Length': str(len(body))}.items():
+                    self.send_header(name, value)
+
+                self.end_headers()
+                self.wfile.write(body[:len(body) // 2] if cut else body)
+
+                if cut:
+                    self.close_connection = True
+
+        return Handler
@@ -0,0 +1,383 @@
+import pytest, os, io, json, time, hashlib, responses
+from zipfile import ZipFile
+import gdoc_api
+from datetime import datetime, timezone
+from gdoc_api import Gdoc, AsyncGdoc, Record, MemberFile, TokenCache, TOKEN_CACHE, PayloadCache, _iter_json_array
+
+os.environ['GDOC_API_TESTING'] = 'True'
+
+API_URL = 'https://foo.bar.baz/GetODSDocuments'
+
+DATA = [
+    {'jobId': 'N2100001', 'odsNo': 'N2100001E', 'symbol1': 'A/RES/1', 'symbol2': '', 'languageId': 'E', 'distributionType': 'GEN', 'title': 'Title 1'},
+    {'jobId': 'N2100002', 'odsNo': 'N2100002F', 'symbol1': 'A/RES/1', 'symbol2': '', 'languageId': 'F', 'distributionType': 'GEN', 'title': 'Titre 1'},
+    {'jobId': '', 'odsNo': 'N2100003E', 'symbol1': 'A/RES/2', 'symbol2': '', 'languageId': 'E', 'distributionType': 'GEN', 'title': 'Title 2'},
+    {'jobId': 'N2100004', 'odsNo': 'N2100004E', 'symbol1': 'A/RES/3', 'symbol2': '', 'languageId': 'E', 'distributionType': 'GEN', 'title': 'Title 3'}
+]
+
+def payload(data=DATA, files=('N2100001.pdf', 'N2100002.pdf', 'N2100003E.pdf', 'N9999999.pdf')) -> bytes:
+    # builds a zip file in the format returned by the gDoc API
+    buffer = io.BytesIO()
+
+    with ZipFile(buffer, 'w') as z:
+        z.writestr('export.txt', json.dumps(data))
+
+        for name in files:
+            z.writestr(name, f'%PDF {name}')
+
+    return buffer.getvalue()
+
+TOKEN_URL = 'https://foo.bar.baz/oauth2/v2.0/token'
+
+def new_gdoc():
+    return Gdoc(
+        client_id='test_client_id',
+        client_secret='test_client_secret',
+        token_url=TOKEN_URL,
+        api_url=API_URL,
+        ocp_apim_subscription_key='test_sub_key',
+        scope=['api://test_scope/.default']
+    )
+
+@pytest.fixture
+def gdoc():
+    g = new_gdoc()
+    g.set_param('dateFrom', '1970-01-01')
+    g.set_param('dateTo', '1970-01-01')
+    g.set_param('dutyStation', 'NY')
+    g.set_param('DownloadFiles', 'Y')
+
+    return g
+
+@responses.activate
+def test_index(gdoc, capsys):
+    responses.get(API_URL, body=payload())
+
+    assert gdoc.record_for('N2100001.pdf')['languageId'] == 'E'
+    assert gdoc.record_for('path/N2100003E.pdf')['symbol1'] == 'A/RES/2'
+    assert gdoc.record_for('N9999999.pdf') is None
+    assert gdoc.record_for('export.txt') is None
+
+    assert gdoc.member_for(DATA[1]) == 'N2100002.pdf'
+    assert gdoc.member_for(DATA[2]) == 'N2100003E.pdf'
+    assert gdoc.member_for(DATA[3]) is None
+
+    # the download manifest check reports the record without a file
+    assert 'File for A/RES/3 not found in zip file' in capsys.readouterr().out
+
+@responses.activate
+def test_iter_files(gdoc, capsys):
+    responses.get(API_URL, body=payload())
+
+    results = list(gdoc.iter_files(lambda fh, data: (fh.read(), data['odsNo'])))
+
+    assert results == [
+        (b'%PDF N2100001.pdf', 'N2100001E'),
+        (b'%PDF N2100002.pdf', 'N2100002F'),
+        (b'%PDF N2100003E.pdf', 'N2100003E')
+    ]
+    assert 'Data for \\"N9999999.pdf\\" not found in zip file' in capsys.readouterr().out
+
+@responses.activate
+def test_iter_files_workers(gdoc):
+    responses.get(API_URL, body=payload())
+
+    def callback(fh, data):
+        # the first file finishes last
+        time.sleep(.1 if data['odsNo'] == 'N2100001E' else 0)
+
+        if data['odsNo'] == 'N2100002F':
+            raise ValueError(data['odsNo'])
+
+        return fh.read()
+
+    results = gdoc.iter_files(callback, workers=4)
+
+    assert next(results) == b'%PDF N2100001.pdf'
+
+    with pytest.raises(ValueError, match='N2100002F'):
+        next(results)
+
+@responses.activate
+def test_download_buffering(gdoc, tmp_path, monkeypatch):
+    responses.get(API_URL, body=payload())
+
+    # before Python 3.11, SpooledTemporaryFile has no `seekable`
+    class SpooledTemporaryFile(gdoc_api.SpooledTemporaryFile):
+        @property
+        def seekable(self):
+            raise AttributeError('seekable')
+
+    monkeypatch.setattr(gdoc_api, 'SpooledTemporaryFile', SpooledTemporaryFile)
+
+    # payloads up to the spool size are kept in memory
+    gdoc.download()
+    assert isinstance(gdoc.tempfile, SpooledTemporaryFile) and not gdoc._mapped
+    assert gdoc.zipfile.read('N2100001.pdf') == b'%PDF N2100001.pdf'
+    assert len(list(gdoc.data)) == 4
+
+    # payloads larger than the spool size are read from a memory map
+    gdoc.spool_size = 100
+    gdoc.download()
+    assert gdoc._mapped
+    assert [fh.read() for fh in gdoc.iter_files(lambda fh, data: fh)][0] == b'%PDF N2100001.pdf'
+
+    # the payload is written directly to save_as and read from there
+    gdoc.download(save_as=tmp_path / 'payload.zip')
+    assert gdoc.zipfile.read('N2100002.pdf') == b'%PDF N2100002.pdf'
+    gdoc.close()
+    assert (tmp_path / 'payload.zip').read_bytes() == payload()
+
+def test_token_cache(tmp_path):
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return {'access_token': str(len(calls)), 'expires_in': 3600}
+
+    cache = TokenCache(path=tmp_path / 'tokens.json')
+    assert cache.get(('a',), fetch)['access_token'] == '1'
+    assert cache.get(('a',), fetch)['access_token'] == '1'
+    assert cache.get(('b',), fetch)['access_token'] == '2'
+
+    # tokens about to expire are refreshed
+    cache.tokens[('a',)]['expires_at'] = time.time() + 30
+    assert cache.get(('a',), fetch)['access_token'] == '3'
+
+    # tokens are reused from the file
+    assert TokenCache(path=tmp_path / 'tokens.json').get(('a',), fetch)['access_token'] == '3'
+    assert len(calls) == 3
+
+@responses.activate
+def test_token_refresh(monkeypatch):
+    monkeypatch.delenv('GDOC_API_TESTING')
+    TOKEN_CACHE.clear()
+    token = responses.post(TOKEN_URL, json={'access_token': 'token', 'token_type': 'Bearer', 'expires_in': 3600})
+    api = responses.get(API_URL, status=401)
+    responses.get(API_URL, body=payload())
+
+    # the token is shared by Gdoc instances
+    new_gdoc()
+    g = new_gdoc()
+    assert token.call_count == 1
+
+    # a rejected token is refreshed once
+    g.set_param('DownloadFiles', 'Y')
+    assert g.data
+    assert token.call_count == 2
+    assert api.call_count == 1
+    assert api.calls[0].request.headers['Authorization'] == 'Bearer token'
+
+@responses.activate
+def test_retry():
+    g = Gdoc(
+        client_id='test_client_id', client_secret='test_client_secret', token_url=TOKEN_URL, api_url=API_URL,
+        ocp_apim_subscription_key='test_sub_key', scope=['api://test_scope/.default'], backoff=0
+    )
+    unavailable = responses.get(API_URL, status=503, headers={'Retry-After': '0'})
+    responses.get(API_URL, body=payload())
+
+    assert g.data
+    assert unavailable.call_count == 1
+    assert g.request_stats[0]['bytes'] == len(payload())
+
+@responses.activate
+def test_async():
+    responses.get(API_URL, body=payload())
+    client = AsyncGdoc(
+        client_id='test_client_id', client_secret='test_client_secret', token_url=TOKEN_URL, api_url=API_URL,
+        ocp_apim_subscription_key='test_sub_key', scope=['api://test_scope/.default'], concurrency=2
+    )
+    client.set_param('DownloadFiles', 'Y')
+    queries = [{'dutyStation': station, 'dateFrom': date, 'dateTo': date} for station in ('NY', 'GE') for date in ('1970-01-01', '1970-01-02')]
+
+    def handler(g):
+        assert g.session is client.session
+        return g.parameters['dutyStation'], g.parameters['dateFrom'], len(list(g.iter_files(lambda fh, data: data)))
+
+    assert client.run(queries, handler) == [
+        ('NY', '1970-01-01', 3), ('NY', '1970-01-02', 3), ('GE', '1970-01-01', 3), ('GE', '1970-01-02', 3)
+    ]
+    assert len(responses.calls) == 4
+
+@responses.activate
+def test_records(gdoc):
+    extra = dict(DATA[0], revision=2)
+    responses.get(API_URL, body=payload(data=DATA + [extra]))
+    parsed = []
+    iter_records = gdoc.iter_records
+    gdoc.iter_records = lambda: parsed.append(1) or iter_records()
+
+    # parse a few characters at a time
+    with gdoc.zipfile.open('export.txt') as fh:
+        assert list(_iter_json_array(io.TextIOWrapper(fh), chunk_size=7)) == DATA + [extra]
+
+    # the manifest check streams the records without keeping them
+    assert len(parsed) == 1 and gdoc.data._list is None
+    parsed.clear()
+
+    records = list(gdoc.data)
+    assert all(isinstance(x, Record) for x in records)
+    assert records[:4] == DATA
+    assert records[4]['revision'] == 2
+    assert dict(records[4]) == extra
+    assert records[0].get('revision') is None
+    # repeated values are shared between records
+    assert records[0]['symbol1'] is records[1]['symbol1']
+
+    with pytest.raises(AttributeError):
+        records[0].jobId = 'x'
+
+    assert len(gdoc.data) == 5
+    assert gdoc.data[2]['odsNo'] == 'N2100003E'
+    # export.txt is parsed once through `data`
+    assert list(gdoc.data) == records
+    assert len(parsed) == 1
+
+@responses.activate
+def test_cache(gdoc, tmp_path):
+    api = responses.get(API_URL, body=payload())
+    gdoc.cache = PayloadCache(tmp_path, max_bytes=len(payload()) * 2)
+
+    assert len(gdoc.data) == 4
+    assert len(gdoc.download().data) == 4
+    assert api.call_count == 1
+
+    # the metadata request is served from the payload with files
+    gdoc.set_param('DownloadFiles', 'N')
+    gdoc.download()
+    assert api.call_count == 1
+
+    # recent dates expire
+    gdoc.set_param('DownloadFiles', 'Y')
+    gdoc.set_param('dateTo', datetime.now(timezone.utc).strftime('%Y-%m-%d'))
+    gdoc.download()
+    gdoc.cache.volatile_ttl = 0
+    time.sleep(.01)
+    gdoc.download()
+    assert api.call_count == 3
+
+    # the least recently used payload is evicted
+    gdoc.set_param('dateTo', '1970-01-02')
+    gdoc.download()
+    gdoc.close()
+    assert len(list(tmp_path.glob('*.zip'))) == 2
+    gdoc.set_param('dateTo', '1970-01-01')
+    gdoc.download()
+    assert api.call_count == 5
+
+    # payloads from another environment are not used
+    other = responses.get(API_URL.replace('foo', 'qa'), body=payload())
+    gdoc.api_url = API_URL.replace('foo', 'qa')
+    gdoc.download()
+    assert other.call_count == 1
+
+@responses.activate
+def test_metrics(gdoc, capsys):
+    responses.get(API_URL, body=payload())
+    list(gdoc.iter_files(lambda fh, data: None))
+
+    summary = gdoc.metrics.summary()
+    assert summary['counters']['downloads'] == 1
+    assert summary['counters']['download_bytes'] == len(payload())
+    assert summary['histograms']['document_seconds']['count'] == 3
+    assert {'download', 'zip_open', 'metadata_index'} <= set(summary['timers'])
+
+    record = gdoc.metrics.emit(dimensions={'station': 'NY'})
+    assert json.loads(capsys.readouterr().out.splitlines()[-1]) == record
+    assert record['_aws']['CloudWatchMetrics'][0]['Dimensions'] == [['station']]
+    assert {'Name': 'download_bytes', 'Unit': 'Bytes'} in record['_aws']['CloudWatchMetrics'][0]['Metrics']
+    assert record['documents'] == 3
+
+    # metrics from another process are added to the totals
+    from gdoc_api.metrics import Metrics
+    metrics = Metrics()
+    metrics.merge(summary)
+    metrics.merge(summary)
+    merged = metrics.summary()
+    assert merged['counters']['downloads'] == 2
+    assert merged['histograms']['document_seconds']['count'] == 6
+    assert sum(merged['histograms']['document_seconds']['buckets'].values()) == 6
+
+def test_resume():
+    from gdoc_api.tests.gdoc_server import GdocServer, make_metadata
+
+    # the local benchmark server cuts off the first response halfway through
+    with GdocServer(make_metadata(12, 6), pdf_size=1000, interrupt=1) as server:
+        g = new_gdoc()
+        g.api_url = server.api_url
+        g.set_param('DownloadFiles', 'Y')
+
+        assert len(list(g.iter_files(lambda fh, data: fh.read()))) == 12
+        assert g.request_stats[0]['resumes'] == 1
+        assert len(server.requests) == 2
+
+@responses.activate
+def test_languages_and_symbols(gdoc):
+    api = responses.get(API_URL, body=payload())
+    gdoc.languages = {'F'}
+    opened = []
+
+    # files in other languages are not opened
+    assert [data['odsNo'] for data in gdoc.iter_files(lambda fh, data: opened.append(fh) or data)] == ['N2100002F']
+    assert len(opened) == 1
+    assert gdoc.metrics.counters['files_filtered'] == 2
+
+    # one request per distinct symbol
+    assert [g.parameters['symbol'] for g in gdoc.iter_symbols(['A/RES/1', 'A/RES/2', 'A/RES/1', ' '])] == ['A/RES/1', 'A/RES/2']
+    assert [x.request.url.split('symbol=')[1] for x in api.calls[1:]] == ['A/RES/1', 'A/RES/2']
+
+@responses.activate
+def test_single_pass(gdoc):
+    responses.get(API_URL, body=payload())
+
+    def callback(fh, data):
+        assert isinstance(fh, MemberFile)
+        assert fh.md5 == hashlib.md5(fh.read()).hexdigest()
+        fh.seek(0)
+
+        return fh.read(), fh.info.file_size
+
+    # the precheck gets the CRC and size from the central directory
+    crc = gdoc.zipfile.getinfo('N2100001.pdf').CRC
+    precheck = lambda info, data: info.CRC != crc
+    results = list(gdoc.iter_files(callback, single_pass=True, precheck=precheck))
+
+    assert results == [(b'%PDF N2100002.pdf', 17), (b'%PDF N2100003E.pdf', 18)]
+
+@responses.activate
+def test_reconcile(gdoc):
+    duplicate = dict(DATA[0], odsNo='N2100001F', languageId='F')
+    responses.get(API_URL, body=payload(data=DATA + [duplicate]))
+    totals = gdoc.reconcile_totals()
+    # the download only checks the manifest, and the totals do not build the report
+    assert gdoc._report is None
+    report = gdoc.reconcile()
+    assert report['totals'] == totals
+
+    assert [x['member'] for x in report['matched']] == ['N2100001.pdf', 'N2100002.pdf', 'N2100003E.pdf', 'N2100001.pdf']
+    assert report['matched'][0]['size'] == len('%PDF N2100001.pdf')
+    assert report['missing_files'] == [{'jobId': 'N2100004', 'odsNo': 'N2100004E', 'symbol1': 'A/RES/3', 'languageId': 'E', 'distributionType': 'GEN'}]
+    assert report['orphan_files'] == [{'member': 'N9999999.pdf', 'size': len('%PDF N9999999.pdf')}]
+    assert report['duplicate_ids'] == [{'id': 'N2100001', 'records': 2}]
+    # the file is imported with the first record that has its id
+    assert gdoc.record_for('N2100001.pdf')['odsNo'] == DATA[0]['odsNo']
+    assert report['totals']['matched_bytes'] == sum(x['size'] for x in report['matched'])
+
+def test_from_zip(tmp_path):
+    path = tmp_path / 'payload.zip'
+    path.write_bytes(payload())
+    g = Gdoc.from_zip(path)
+
+    assert len(g.data) == 4
+    assert list(g.iter_files(lambda fh, data: fh.read()))[0] == b'%PDF N2100001.pdf'
+
+    # the payload is read from the disk again after it is released
+    g.close()
+    assert g.record_for('N2100002.pdf')['odsNo'] == 'N2100002F'
+    g.close()
+
+    (tmp_path / 'bad.zip').write_bytes(b'not a zip file')
+
+    with pytest.raises(Exception, match='cannot be read as a zip file'):
+        Gdoc.from_zip(tmp_path / 'bad.zip')
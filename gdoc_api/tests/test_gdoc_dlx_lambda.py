@@ -0,0 +1,54 @@
+import pytest, os, json, importlib.util
+
+os.environ.update({'DLX_ENV': 'testing', 'GDOC_ENV': 'testing'})
+
+SUMMARY = {'files': 1, 'imported': 1, 'metrics': {'timers': {'init_args': .1, 'init_connect': .2, 'init_gdoc': .3}}}
+
+@pytest.fixture
+def service(monkeypatch):
+    # the Lambda function is not in a package
+    path = os.path.join(os.path.dirname(__file__), '..', '..', 'gdoc-dlx-lambda', 'service.py')
+    spec = importlib.util.spec_from_file_location('service', path)
+    service = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(service)
+
+    from gdoc_api.scripts import gdoc_dlx, gdoc_dlx_fanout
+    calls = []
+    monkeypatch.setattr(gdoc_dlx, 'run', lambda **kwargs: calls.append(('run', kwargs)) or SUMMARY)
+    monkeypatch.setattr(gdoc_dlx_fanout, 'work', lambda item: calls.append(('work', item)) or {**SUMMARY, 'batch': item['batch']})
+    monkeypatch.setattr(gdoc_dlx_fanout, 'plan', lambda **kwargs: calls.append(('plan', kwargs)) or [{'batch': 0, 'symbols': ['A/1']}])
+    service.calls = calls
+
+    return service
+
+def test_run(service):
+    response = service.handler({'duty_station': 'NY', 'days_ago': 1}, None)
+
+    assert response['status_code'] == 200
+    assert response['cold_start'] is True
+    assert response['init_seconds'] == {'import': response['init_seconds']['import'], 'args': .1, 'connect': .2, 'gdoc': .3}
+    assert response['summary'] == {'files': 1, 'imported': 1}
+    assert service.calls[0][0] == 'run' and service.calls[0][1]['station'] == 'NY'
+
+    # the modules and connections are kept for warm invocations
+    assert service.handler({'duty_station': 'NY', 'days_ago': 1}, None)['cold_start'] is False
+
+    with pytest.raises(Exception, match='"days_ago" is required'):
+        service.handler({'duty_station': 'NY'}, None)
+
+def test_plan(service):
+    response = service.handler({'duty_station': 'GE', 'days_ago': 2, 'mode': 'plan', 'batch_size': 10}, None)
+
+    assert response['work_items'] == [{'batch': 0, 'symbols': ['A/1']}]
+    assert service.calls[0][1]['station'] == 'GE' and service.calls[0][1]['batch_size'] == 10
+
+def test_work_items(service):
+    assert service.handler({'work_item': {'batch': 3}}, None)['summary'] == [{'files': 1, 'imported': 1, 'batch': 3}]
+
+    event = {'Records': [{'body': json.dumps({'batch': 0})}, {'body': json.dumps({'batch': 1})}]}
+    assert [x['batch'] for x in service.handler(event, None)['summary']] == [0, 1]
+
+    # an SQS event without records
+    response = service.handler({'Records': []}, None)
+    assert response['summary'] == []
+    assert response['init_seconds']['args'] == 0
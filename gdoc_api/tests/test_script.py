@@ -1,4 +1,4 @@
-import pytest, os
+import pytest, os, re, responses
 from gdoc_api import Gdoc
 from gdoc_api.scripts import gdoc_dlx
 from moto import mock_aws
@@ -64,8 +64,18 @@ def test_args(ssm_mock):
     kwargs.update({'symbol': 'A/RES/1'})
     kwargs.update({'language': 'E'})
     args = gdoc_dlx.get_args(**kwargs)
-    assert args.symbol == 'A/RES/1'
-    assert args.language == 'E'
+    assert args.symbol == ['A/RES/1']
+    assert args.language == ['E']
+
+    # scripts that only need DLX resolve the connection in the same way
+    assert gdoc_dlx.dlx_connection() == ('dummy', 'dev_undlFiles')
+    assert gdoc_dlx.dlx_connection('mongodb://x', 'db') == ('mongodb://x', 'db')
+
+    # lists of symbols and languages
+    kwargs.update({'symbol': ['A/RES/1', 'A/RES/2'], 'language': ['E', 'F']})
+    args = gdoc_dlx.get_args(**kwargs)
+    assert args.symbol == ['A/RES/1', 'A/RES/2']
+    assert args.language == ['E', 'F']
 
 @pytest.mark.skip("Not passing yet")
 def test_run(ssm_mock):
@@ -77,3 +87,251 @@ def test_run(ssm_mock):
     }
 
     assert gdoc_dlx.run(**kwargs)
+
+def test_log_buffer():
+    class Collection():
+        def __init__(self):
+            self.writes = []
+
+        def insert_many(self, docs, ordered=True):
+            assert not ordered
+            self.writes.append(docs)
+
+    col = Collection()
+
+    with pytest.raises(ValueError):
+        with gdoc_dlx.LogBuffer(col, size=2) as log:
+            for i in range(3):
+                log.insert({'i': i})
+
+            assert col.writes == [[{'i': 0}, {'i': 1}]]
+
+            raise ValueError
+
+    # the remaining document is written on exit
+    assert col.writes == [[{'i': 0}, {'i': 1}], [{'i': 2}]]
+
+def test_ssm_cache(ssm_mock):
+    gdoc_dlx.SSM_CACHE.clear()
+    args = gdoc_dlx.get_args(station='NY', date='1970-01-01')
+    assert args.gdoc_client_id == 'test_client_id'
+
+    # the parameters are reused until the TTL expires
+    ssm_mock.put_parameter(Name='gdoc-testing-api-secrets', Value=json.dumps({'client_id': 'new'}), Type='String', Overwrite=True)
+    assert gdoc_dlx.get_args(station='NY', date='1970-01-01').gdoc_client_id == 'test_client_id'
+
+    gdoc_dlx.SSM_CACHE.ttl = 0
+    assert gdoc_dlx.get_args(station='NY', date='1970-01-01').gdoc_client_id == 'new'
+    gdoc_dlx.SSM_CACHE.ttl = 900
+    gdoc_dlx.SSM_CACHE.clear()
+
+    with pytest.raises(Exception, match='SSM parameters not found'):
+        gdoc_dlx.SSM_CACHE.get(['not-a-parameter'])
+
+def test_fanout_balance():
+    from gdoc_api.scripts.gdoc_dlx_fanout import balance, LocalQueue
+
+    counts = {'A/1': 6, 'A/2': 6, 'A/3': 4, 'A/4': 2, 'A/5': 1, 'A/6': 1}
+    batches = balance(counts, 10)
+
+    assert len(batches) == 2
+    assert sorted(x for batch in batches for x in batch) == sorted(counts)
+    assert [sum(counts[x] for x in batch) for batch in batches] == [10, 10]
+    assert balance({'A/1': 30}, 10) == [['A/1']]
+    assert balance({}, 10) == []
+
+    # work items pass through the queue as JSON
+    queue = LocalQueue()
+    queue.send({'symbols': batches[0], 'batch': 0})
+    assert len(queue) == 1
+    assert queue.receive() == {'symbols': batches[0], 'batch': 0}
+    assert queue.receive() is None
+
+@responses.activate
+def test_plan_windows():
+    from urllib.parse import urlparse, parse_qs
+    from gdoc_api.tests.test_gdoc import payload, new_gdoc, API_URL
+
+    # 3 documents a day, except none on the 3rd
+    def callback(request):
+        q = parse_qs(urlparse(request.url).query)
+        days = range(int(q['dateFrom'][0][-2:]), int(q['dateTo'][0][-2:]) + 1)
+        data = [{'jobId': f'N{day}{i}', 'odsNo': f'N{day}{i}E', 'symbol1': f'A/{day}/{i}'} for day in days if day != 3 for i in range(3)]
+
+        return (200, {}, payload(data=data, files=()))
+
+    responses.add_callback('GET', re.compile(API_URL + '.*'), callback=callback)
+    windows = gdoc_dlx.plan_windows(new_gdoc(), '1970-01-01', '1970-01-06', 7)
+    assert windows[2][2][0]['jobId'] == 'N60'
+
+    assert [(date_from, date_to, len(records)) for date_from, date_to, records in windows] == [
+        ('1970-01-01', '1970-01-03', 6),
+        ('1970-01-04', '1970-01-05', 6),
+        ('1970-01-06', '1970-01-06', 3)
+    ]
+
+    with pytest.raises(Exception, match='must not be before'):
+        gdoc_dlx.plan_windows(new_gdoc(), '1970-01-02', '1970-01-01', 7)
+
+def test_bib_batch(monkeypatch, capsys):
+    committed = []
+
+    class Bib(gdoc_dlx.Bib):
+        def commit(self, user=None):
+            if 'A/RES/2' in self.get_values('191', 'a'):
+                raise Exception('invalid record')
+
+            committed.append((self.get_values('191', 'a'), self.get_values('246', 'a')))
+
+    monkeypatch.setattr(gdoc_dlx, 'Bib', Bib)
+    monkeypatch.setattr(gdoc_dlx, 'find_bib_symbols', lambda symbols: {'A/RES/3'} & set(symbols))
+
+    bibs = gdoc_dlx.BibBatch()
+    bibs.lookup(['A/RES/1', 'A/RES/2', 'A/RES/3'])
+    assert bibs.add(['A/RES/1'], ['Title 1'])
+    # titles from later files for the same symbol are added to the pending bib
+    assert not bibs.add(['A/RES/1'], ['Title 1', 'Titre 1'])
+    assert bibs.add(['A/RES/2'], ['Title 2'])
+    assert not bibs.add(['A/RES/3'], ['Title 3'])
+
+    # nothing is written until the end of the stage, and a failed record does not stop the others
+    assert committed == []
+    assert bibs.commit() == {'bibs_created': 1, 'bibs_failed': 1}
+    assert committed == [(['A/RES/1'], ['Title 1', 'Titre 1'])]
+    assert '"error": "invalid record", "data": {"symbols": ["A/RES/2"]}' in capsys.readouterr().out
+
+def test_file_index():
+    from zipfile import ZipInfo
+    from dlx import DB
+    from gdoc_api.scripts import gdoc_file_index
+    from gdoc_api.scripts.gdoc_file_index import FileIndex
+
+    DB.connect('mongomock://localhost', database='file_index')
+    info = ZipInfo('N2100000.pdf')
+    info.CRC, info.file_size = 123, 456
+    key = FileIndex.key({'jobId': 'N2100000', 'odsNo': 'N2100000E'}, info)
+    assert key == ('N2100000', 123, 456)
+
+    with FileIndex.load(size=10) as index:
+        assert index.get(key) is None
+        index.add(key, 'checksum', ['A/1'])
+        index.add(key, 'checksum', ['A/1/Add.1'])
+        index.add(('N2100009', 1, 1), 'other', ['A/9'])
+        index.discard(('N2100009', 1, 1))
+        # the writes are buffered, one per entry
+        assert DB.handle['gdoc_file_index'].count_documents({}) == 0
+        assert len(index.pending) == 2
+
+    # entries are saved when the context exits, and loaded by the next run
+    index = FileIndex.load()
+    assert index.get(key) == {'file_id': 'checksum', 'symbols': {'A/1', 'A/1/Add.1'}}
+    assert index.get(('N2100000', 123, 457)) is None
+    assert index.stats() == {'entries': 1, 'hits': 1, 'misses': 1, 'hit_rate': .5}
+
+    # the index is rebuilt from the log, for the files that are still in DLX
+    DB.handle['gdoc_log'].insert_many(
+        [
+            {'imported': True, 'gdoc_job_id': 'N2100000', 'gdoc_crc': 123, 'gdoc_size': 456, 'gdoc_checksum': 'a', 'time': 1},
+            {'imported': False, 'message': {'info': 'Already in the system'}, 'gdoc_job_id': None, 'gdoc_ods_no': 'N2100001E', 'gdoc_crc': 1, 'gdoc_size': 2, 'gdoc_checksum': 'b', 'time': 2},
+            {'imported': True, 'gdoc_job_id': 'N2100002', 'gdoc_crc': 3, 'gdoc_size': 4, 'gdoc_checksum': 'c', 'time': 3}
+        ]
+    )
+    DB.handle['files'].insert_many([{'_id': 'a', 'identifiers': [{'type': 'symbol', 'value': 'A/1'}]}, {'_id': 'b', 'identifiers': [{'type': 'symbol', 'value': 'A/2'}]}])
+    assert gdoc_file_index.rebuild() == 2
+    assert FileIndex.load().entries == {('N2100000', 123, 456): {'file_id': 'a', 'symbols': {'A/1'}}, ('N2100001E', 1, 2): {'file_id': 'b', 'symbols': {'A/2'}}}
+
+    # the next run reconnects to its own database
+    gdoc_dlx._connected.pop('dlx', None)
+
+def test_plan_incremental():
+    from dlx import DB
+
+    DB.connect('mongomock://localhost', database='plan_incremental')
+    record = {'jobId': 'N1', 'odsNo': 'N1E', 'symbol1': 'A/1', 'symbol2': ' ', 'languageId': 'E', 'distributionType': 'GEN'}
+    data = [
+        record,
+        dict(record, jobId='N2', odsNo='N2E', distributionType='RES'),
+        dict(record, jobId='N3', odsNo='N3E', symbol1='A/JOURNAL/1'),
+        dict(record, jobId='N4', odsNo='N4E'),
+        dict(record, jobId='N5', odsNo='N5E', title='Revised')
+    ]
+    DB.handle['gdoc_log'].insert_one({'imported': False, 'message': {'info': 'File not in payload'}, 'gdoc_job_id': 'N4', 'gdoc_fingerprint': gdoc_dlx.fingerprint(data[3])})
+    DB.handle['gdoc_log'].insert_one({'imported': False, 'message': {'info': 'Unchanged'}, 'gdoc_job_id': 'N5', 'gdoc_fingerprint': gdoc_dlx.fingerprint(data[4])})
+
+    # documents that are never imported, and files skipped by the file index, are not planned again. documents
+    # whose file was not in the payload are, as the file may be added later
+    assert gdoc_dlx.plan_incremental(data) == [record, data[3]]
+
+    gdoc_dlx._connected.pop('dlx', None)
+
+def test_import_symbols_bibs(monkeypatch):
+    from types import SimpleNamespace
+    from contextlib import nullcontext
+    from gdoc_api.metrics import Metrics
+
+    class G():
+        metrics = Metrics()
+
+        def set_param(self, name, value):
+            pass
+
+        def iter_symbols(self, symbols):
+            yield self
+            raise Exception('API reponse not OK')
+
+    class Bibs():
+        committed = False
+
+        def commit(self):
+            self.committed = True
+
+            return {'bibs_created': 1}
+
+    monkeypatch.setattr(gdoc_dlx, 'DLX', SimpleNamespace(handle={'gdoc_log': None}))
+    monkeypatch.setattr(gdoc_dlx, 'LogBuffer', lambda *args, **kwargs: nullcontext())
+    monkeypatch.setattr(gdoc_dlx, 'import_files', lambda *args, **kwargs: {'files': 1})
+    bibs = Bibs()
+
+    # the bibs queued for the first symbol are created when the second fails
+    with pytest.raises(Exception, match='not OK'):
+        gdoc_dlx.import_symbols(G(), SimpleNamespace(create_bibs=True, overwrite=True), ['A/1', 'A/2'], bibs)
+
+    assert bibs.committed
+
+def test_retro(monkeypatch):
+    from datetime import datetime
+    from dlx import DB
+    from gdoc_api.scripts import gdoc_dlx_retro
+
+    DB.connect('mongomock://localhost', database='retro')
+    runs = []
+
+    def run(*, station, date, recursive):
+        runs.append((station, date))
+
+        if date == '2020-01-02' and station == 'GE':
+            raise Exception('API reponse not OK')
+
+        errors = 2 if date == '2020-01-03' and station == 'NY' else 0
+
+        return {'files': 2, 'metrics': {'counters': {'files_error': errors}}}
+
+    monkeypatch.setattr(gdoc_dlx_retro.gdoc_dlx, 'run', run)
+
+    # a day where all the files failed to import is not completed
+    results = gdoc_dlx_retro.backfill('2020-01-01', '2020-01-03', workers=2)
+    assert sorted((x['station'], x['issue_date'].day, x['status']) for x in results if x['status'] == 'failed') == [('GE', 2, 'failed'), ('NY', 3, 'failed')]
+
+    # only the station-days that have not completed are run again
+    runs.clear()
+    gdoc_dlx_retro.backfill('2020-01-01', '2020-01-03')
+    assert sorted(runs) == [('GE', '2020-01-02'), ('NY', '2020-01-03')]
+
+    # the daily run skips the days completed by the backfill, and only runs the stations that have not completed
+    DB.handle['gdoc_dlx_retro'].insert_one({'issue_date': datetime(2019, 12, 31)})
+    runs.clear()
+    assert [x['status'] for x in gdoc_dlx_retro.run_next()] == ['failed']
+    assert runs == [('GE', '2020-01-02')]
+    assert DB.handle['gdoc_dlx_retro'].find_one({}, sort=[('issue_date', -1)])['issue_date'] == datetime(2020, 1, 1)
+
+    gdoc_dlx._connected.pop('dlx', None)
@@ -23,7 +23,10 @@ setup(
     python_requires = '>=3.9',
     entry_points = {
         'console_scripts': [
-            'gdoc-dlx=gdoc_api.scripts.gdoc_dlx:run'
+            'gdoc-dlx=gdoc_api.scripts.gdoc_dlx:run',
+            'gdoc-dlx-retro=gdoc_api.scripts.gdoc_dlx_retro:main',
+            'gdoc-dlx-fanout=gdoc_api.scripts.gdoc_dlx_fanout:main',
+            'gdoc-file-index=gdoc_api.scripts.gdoc_file_index:main'
         ]
     }
 )